@@ -0,0 +1,319 @@
+#!/usr/bin/env python3
+
+# Measures feedget ingestion against synthetic feeds served from a local
+# HTTP server, so runs can be compared without touching live providers.
+#
+#   ./feedbench.py --rows 200000 --events 500 --attributes 100
+#   ./feedbench.py --mongo localhost:27017 --processes 4 --json run.json
+
+import os
+import sys
+import json
+import time
+import uuid
+import yaml
+import random
+import queue
+import shutil
+import zipfile
+import argparse
+import tempfile
+import traceback
+import resource
+import threading
+import functools
+import multiprocessing
+from datetime import datetime as dt, timedelta as td
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+
+BENCH_DB = 'feedbench'
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+def sample_time(i):
+    return dt(2019, 1, 1) + td(seconds=i * 37 % (365 * 86400))
+
+def write_urlhaus(path, rows):
+    with open(path, 'w') as f:
+        f.write('################################################################\n')
+        f.write('# abuse.ch URLhaus Database Dump (CSV)                         #\n')
+        f.write('# id,dateadded,url,url_status,threat,tags,urlhaus_link,reporter\n')
+        f.write('################################################################\n')
+        for i in range(rows):
+            f.write('"%d","%s","http://malware%d.example.com/bins/x86","online","malware_download","elf,mirai","https://urlhaus.abuse.ch/url/%d/","bench"\n' % (i, sample_time(i).strftime('%Y-%m-%d %H:%M:%S'), i, i))
+
+def write_phishtank(path, rows):
+    with open(path, 'w') as f:
+        f.write('phish_id,url,phish_detail_url,submission_time,verified,verification_time,online,target\n')
+        for i in range(rows):
+            submitted = sample_time(i)
+            f.write('%d,http://phish%d.example.net/login.php?id=%d,http://www.phishtank.com/phish_detail.php?phish_id=%d,%s,yes,%s,yes,Other\n' % (i, i, i, i, submitted.strftime('%Y-%m-%dT%H:%M:%S+00:00'), (submitted + td(minutes=10)).strftime('%Y-%m-%dT%H:%M:%S+00:00')))
+
+def write_misp(path, events, attributes):
+    os.makedirs(path)
+    manifest = {}
+    for e in range(events):
+        event_uuid = str(uuid.uuid4())
+        timestamp = str(int(sample_time(e).timestamp()))
+        event = {'Event': {'uuid': event_uuid, 'info': 'Bench event %d' % e, 'timestamp': timestamp, 'Tag': [{'name': 'tlp:white'}, {'name': 'osint:source-type="blog-post"'}], 'Attribute': []}}
+        for a in range(attributes):
+            event['Event']['Attribute'].append({'uuid': str(uuid.uuid4()), 'type': 'domain', 'category': 'Network activity', 'value': 'c2-%d-%d.example.org' % (e, a), 'comment': '', 'timestamp': timestamp, 'to_ids': True})
+        with open(os.path.join(path, event_uuid + '.json'), 'w') as f:
+            json.dump(event, f)
+        manifest[event_uuid] = {'info': event['Event']['info'], 'timestamp': timestamp, 'Tag': event['Event']['Tag']}
+    with open(os.path.join(path, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f)
+
+def write_kaspersky(path, rows, base_url):
+    os.makedirs(path)
+    attrs = []
+    for i in range(rows):
+        seen = sample_time(i).strftime('%d.%m.%Y %H:%M')
+        if i % 4 == 0:
+            digest = uuid.UUID(int=random.getrandbits(128)).hex
+            attrs.append({'id': i, 'MD5': digest, 'SHA1': digest + digest[:8], 'SHA256': digest * 2, 'first_seen': seen, 'last_seen': seen, 'threat': 'HEUR:Trojan.Win32.Generic', 'category': 'Malware'})
+        else:
+            attrs.append({'id': i, 'mask': 'evil%d.example.com/path/%d' % (i, i), 'type': 3, 'first_seen': seen, 'last_seen': seen, 'category': 'Malware'})
+    with zipfile.ZipFile(os.path.join(path, 'package.zip'), 'w', zipfile.ZIP_DEFLATED) as package:
+        package.writestr('feed.json', json.dumps(attrs))
+    with open(os.path.join(path, 'updates.json'), 'w') as f:
+        json.dump({'updates': [{'id': 1, 'packages': [{'link': base_url + '/kaspersky/package.zip'}]}]}, f)
+
+def generate(root, base_url, args):
+    write_urlhaus(os.path.join(root, 'urlhaus.csv'), args.rows)
+    write_phishtank(os.path.join(root, 'phishtank.csv'), args.rows)
+    write_misp(os.path.join(root, 'misp'), args.events, args.attributes)
+    write_kaspersky(os.path.join(root, 'kaspersky'), args.rows, base_url)
+    return [
+        {'name': 'URLHaus CSV', 'provider': 'Bench', 'url': base_url + '/urlhaus.csv', 'format': 'csv', 'category': 'Network activity', 'type': 'url', 'delimiter': ',', 'valuefield': 2, 'timestampfield': 1, 'timestampformat': '%Y-%m-%d %H:%M:%S', 'commentfield': 4, 'tags': ['malware']},
+        {'name': 'Phishtank CSV', 'provider': 'Bench', 'url': base_url + '/phishtank.csv', 'format': 'csv', 'ignorecsvheader': True, 'type': 'url', 'category': 'phishing', 'valuefield': 1, 'linkfield': 2, 'timestampfield': 5, 'timestampformat': '%Y-%m-%dT%H:%M:%S%z', 'commentfield': 7, 'tags': ['phishing']},
+        {'name': 'MISP feed', 'provider': 'Bench', 'url': base_url + '/misp', 'format': 'misp'},
+        {'name': 'Kaspersky feed', 'provider': 'Bench', 'url': base_url + '/kaspersky/updates.json', 'format': 'kaspersky', 'timestampformat': '%d.%m.%Y %H:%M'},
+    ]
+
+class BulkResult:
+    def __init__(self, upserted_count, modified_count):
+        self.upserted_count = upserted_count
+        self.modified_count = modified_count
+
+class RecordedUpdate:
+    # Stands in for pymongo's UpdateOne when feedget writes to a
+    # MemoryCollection, keeping the operation readable.
+    def __init__(self, filter, update, upsert=False):
+        self.filter = filter
+        self.update = update
+        self.upsert = upsert
+
+class MemoryCollection:
+    # The subset of a pymongo collection used by IOCReader, kept in a dict.
+    def __init__(self):
+        self.docs = {}
+
+    def find(self, query, projection=None):
+        for value in query['value']['$in']:
+            if (value, query['url']) in self.docs:
+                yield self.docs[(value, query['url'])]
+
+    def find_one(self, query):
+        return self.docs.get(query['_id'])
+
+    def update_one(self, query, update, upsert=False):
+        self.docs.setdefault(query['_id'], {}).update(update['$set'])
+
+    def bulk_write(self, requests, ordered=True):
+        upserted = 0
+        modified = 0
+        for request in requests:
+            key = (request.filter['value'], request.filter['url'])
+            if key in self.docs:
+                modified += 1
+            else:
+                upserted += 1
+                self.docs[key] = dict(request.update['$setOnInsert'])
+            self.docs[key].update(request.update['$set'])
+        return BulkResult(upserted, modified)
+
+class MemoryDatabase:
+    def __init__(self):
+        self.collections = {}
+
+    def __getattr__(self, name):
+        return self.collections.setdefault(name, MemoryCollection())
+
+def descendants(pid):
+    # pids of the processes below pid, e.g. the forkserver and its pool workers
+    children = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open('/proc/%s/stat' % entry) as f:
+                stat = f.read()
+        except OSError:
+            continue
+        # the command name in parentheses may contain spaces
+        ppid = int(stat[stat.rindex(')') + 2:].split()[1])
+        children.setdefault(ppid, []).append(int(entry))
+    pids = []
+    pending = [pid]
+    while pending:
+        for child in children.get(pending.pop(), []):
+            pids.append(child)
+            pending.append(child)
+    return pids
+
+def rss_kb(pid):
+    try:
+        with open('/proc/%d/status' % pid) as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return 0
+
+class WorkerMemory:
+    # Samples the summed RSS of the processes below this one while a feed
+    # runs. Forkserver workers are not children of this process, so
+    # RUSAGE_CHILDREN does not see them.
+    def __init__(self, interval=0.1):
+        self.interval = interval
+        self.peak = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        pid = os.getpid()
+        while True:
+            self.peak = max(self.peak, sum(rss_kb(child) for child in descendants(pid)))
+            if self.stopped.wait(self.interval):
+                break
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        return self.peak
+
+def failed_result(feed, error):
+    return {'feed': feed['name'], 'status': 'Failed', 'error': error, 'rows': 0, 'bytes': 0, 'seconds': 0, 'rows_per_second': 0, 'peak_rss_mb': 0, 'worker_rss_mb': 0, 'download_seconds': 0, 'parse_seconds': 0, 'load_seconds': 0}
+
+def run_scenario(config_file, feed, mongo, results):
+    # the parent waits for a result, so a scenario that fails still puts one
+    try:
+        results.put(scenario(config_file, feed, mongo))
+    except Exception as e:
+        traceback.print_exc()
+        results.put(failed_result(feed, str(e)))
+
+def scenario(config_file, feed, mongo):
+    import feedget
+    from feedget import IOCReader
+    reader = IOCReader(config_file)
+    if mongo is None:
+        feedget.UpdateOne = RecordedUpdate
+        reader.db = MemoryDatabase()
+        reader.col = reader.db.iocs
+    else:
+        reader.db.client.drop_database(BENCH_DB)
+        reader.db = reader.db.client[BENCH_DB]
+        reader.col = reader.db.iocs
+        reader.col.create_index([('value', 1), ('url', 1)], unique=True)
+    workers = WorkerMemory()
+    start = time.perf_counter()
+    try:
+        reader.process_feed(feed)
+    finally:
+        worker_rss = workers.stop()
+        reader.close()
+    elapsed = time.perf_counter() - start
+    stats = reader.feed_stats.snapshot()[feed['name']]
+    # ru_maxrss is in kilobytes on Linux
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return {
+        'feed': feed['name'],
+        'status': stats.get('status'),
+        'error': stats.get('error'),
+        'rows': stats.get('count', 0),
+        'bytes': stats.get('bytes', 0),
+        'seconds': elapsed,
+        'rows_per_second': stats.get('count', 0) / elapsed if elapsed > 0 else 0,
+        'peak_rss_mb': rss / 1024.0,
+        'worker_rss_mb': worker_rss / 1024.0,
+        'download_seconds': stats.get('download_time', 0),
+        'parse_seconds': stats.get('parse_time', 0),
+        'load_seconds': stats.get('load_time', 0),
+    }
+
+def wait_result(process, results, feed):
+    # a child that dies without putting a result (killed, out of memory) counts as failed
+    while True:
+        try:
+            return results.get(timeout=1)
+        except queue.Empty:
+            if not process.is_alive():
+                return failed_result(feed, 'Exited with code %s' % process.exitcode)
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark feedget ingestion against local synthetic feeds.')
+    parser.add_argument('--rows', dest='rows', type=int, default=100000, help='Rows of the csv and Kaspersky feeds')
+    parser.add_argument('--events', dest='events', type=int, default=200, help='Events of the MISP feed')
+    parser.add_argument('--attributes', dest='attributes', type=int, default=100, help='Attributes per MISP event')
+    parser.add_argument('--feeds', dest='feeds', type=str, nargs='+', default=None, help='Only run the feeds with these formats (csv, misp, kaspersky)')
+    parser.add_argument('--mongo', dest='mongo', type=str, default=None, help='host:port of a local mongod, default is an in-process stand-in')
+    parser.add_argument('--processes', dest='processes', type=int, default=0, help='Value for general.processes')
+    parser.add_argument('--batchsize', dest='batchsize', type=int, default=10000, help='Value for general.batchsize')
+    parser.add_argument('--bulksize', dest='bulksize', type=int, default=1000, help='Value for general.bulksize')
+    parser.add_argument('--concurrency', dest='concurrency', type=int, default=8, help='Value for general.concurrency')
+    parser.add_argument('--json', dest='json', type=str, default=None, help='Also write the results to this file')
+    args = parser.parse_args()
+
+    sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)))
+    root = tempfile.mkdtemp(prefix='feedbench-')
+    server = ThreadingHTTPServer(('127.0.0.1', 0), functools.partial(QuietHandler, directory=root))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = 'http://127.0.0.1:%d' % server.server_address[1]
+    try:
+        run_benchmark(root, base_url, args)
+    finally:
+        server.shutdown()
+        shutil.rmtree(root)
+
+def run_benchmark(root, base_url, args):
+    print('Generating feeds in ' + root + ' ...')
+    feeds = generate(root, base_url, args)
+    if args.feeds:
+        feeds = [feed for feed in feeds if feed['format'] in args.feeds]
+    host, port = args.mongo.split(':') if args.mongo else ('localhost', 27017)
+    config = {
+        'general': {'threads': 1, 'batchsize': args.batchsize, 'bulksize': args.bulksize, 'concurrency': args.concurrency, 'incremental': False, 'fetchcache': False, 'skipunchanged': True, 'processes': args.processes, 'timeout': 86400, 'interval': 86400, 'layout': 'full', 'lease': 300},
+        'stats': {'interval': 1, 'terminal': False},
+        'mongo': {'host': host, 'port': int(port), 'db': BENCH_DB},
+        'kaspersky': {'tempdir': root, 'spoolsize': 64 * 1024 * 1024},
+        'feeds': feeds,
+    }
+    config_file = os.path.join(root, 'config.yml')
+    with open(config_file, 'w') as f:
+        yaml.safe_dump(config, f)
+
+    # every feed runs in a fresh interpreter so that peak RSS is its own
+    context = multiprocessing.get_context('spawn')
+    results = []
+    for feed in feeds:
+        result_queue = context.Queue()
+        process = context.Process(target=run_scenario, args=(config_file, feed, args.mongo, result_queue))
+        process.start()
+        results.append(wait_result(process, result_queue, feed))
+        process.join()
+
+    print('%-16s : %-10s : %10s : %8s : %10s : %8s : %10s : %8s : %8s : %8s : %s' % ('feed', 'status', 'rows', 'seconds', 'rows/s', 'rss MB', 'workers MB', 'download', 'parse', 'load', 'error'))
+    for result in results:
+        print('%-16s : %-10s : %10d : %8.2f : %10d : %8.1f : %10.1f : %8.2f : %8.2f : %8.2f : %s' % (result['feed'], result['status'], result['rows'], result['seconds'], result['rows_per_second'], result['peak_rss_mb'], result['worker_rss_mb'], result['download_seconds'], result['parse_seconds'], result['load_seconds'], result['error']))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'args': vars(args), 'results': results}, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -4,322 +4,973 @@ import sys
 import os
 import yaml
 import requests
-import uuid
-import csv
 import json
-import dateparser
 import urllib.request
 import re
+import time
 import zipfile
+import tempfile
+import io
 import fcntl
 import threading
+import signal
+import argparse
+import codecs
+import multiprocessing
+import hashlib
+import queue
+import socket
 from timeout import timeout
-from datetime import datetime as dt
-from pymongo import MongoClient
-from pymongo.errors import BulkWriteError
+from timestamps import TimestampParser
+from ioclayout import FeedRefs
+from feedparse import IOC, parse_csv_fanout, parse_csv_lines, parse_kaspersky_attrs, parse_misp_event, run_parser
+from datetime import datetime as dt, timedelta as td
+from pymongo import MongoClient, ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
 from contextlib import closing
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
 from multiprocessing.dummy import Pool as ThreadPool
 
+class FeedUnchanged(Exception):
+    pass
+
+class FeedTimeout(Exception):
+    pass
+
 class KasperskyReader:
+    re_sep = re.compile(r'[\s,]*')
+
     def __init__(self, config):
         self.config = config
         if sys.version_info >= (2, 7, 9):
             # since 2.7.9 version Python perform certificate and hostname checks by default
             import ssl
             ctx = ssl._create_unverified_context()
-            ctx.load_cert_chain(certfile=self.config['pemfile'])
+            if self.config.get('pemfile'):
+                ctx.load_cert_chain(certfile=self.config['pemfile'])
             https_handler = urllib.request.HTTPSHandler(context=ctx)
         else:
             https_handler = urllib.request.HTTPSHandler()
 
         self.opener = urllib.request.build_opener(https_handler)
 
-    def parse_filename(self, headers):
-        if not 'content-disposition' in headers:
-            filename = str(uuid.uuid4()) + ".zip"
-            return filename
-        return re.findall("filename=(\S+)", headers['content-disposition'])[0]
+    def iter_json_array(self, f_in, chunksize=65536):
+        decoder = json.JSONDecoder()
+        buf = ''
+        pos = 0
+        eof = False
+        started = False
+        while True:
+            if not eof and len(buf) - pos < chunksize:
+                chunk = f_in.read(chunksize)
+                eof = not chunk
+                buf = buf[pos:] + chunk
+                pos = 0
+            pos = self.re_sep.match(buf, pos).end()
+            if pos >= len(buf):
+                if eof:
+                    raise Exception("Unexpected end of JSON array")
+                continue
+            if not started:
+                if buf[pos] != '[':
+                    raise Exception("Expected a JSON array")
+                started = True
+                pos += 1
+                continue
+            if buf[pos] == ']':
+                return
+            try:
+                obj, end = decoder.raw_decode(buf, pos)
+            except ValueError:
+                if eof:
+                    raise
+                end = len(buf)
+            if end == len(buf) and not eof:
+                # the element might continue in the next chunk
+                chunk = f_in.read(chunksize)
+                eof = not chunk
+                buf = buf[pos:] + chunk
+                pos = 0
+                continue
+            yield obj
+            pos = end
 
-    def download_feed(self, feed_url):
-        with closing(self.opener.open(feed_url)) as resp:
+    def latest_update(self, feed_url, timeout=None):
+        with closing(self.opener.open(feed_url, timeout=timeout)) as resp:
             if resp.getcode() != 200:
                 raise Exception("Failed to download feed '{0}'".format(feed_url))
 
             result = json.loads(resp.read())
-            package_url = result['updates'][0]['packages'][0]['link']
-
-        with closing(self.opener.open(package_url)) as resp:
-            if resp.getcode() != 200:
-                raise Exception("Failed to download package from '{0}'".format(package_url))
+            return result['updates'][0]
 
-            package_name = self.parse_filename(resp.headers)
-
-            temp_file = os.path.join(self.config['tempdir'], package_name)
-            with open(temp_file, 'wb') as feed_archive:
-                feed_archive.write(resp.read())
+    def download_package(self, update, remaining):
+        # remaining returns the seconds left for the feed and raises once its deadline passed
+        package_url = update['packages'][0]['link']
+        spool = tempfile.SpooledTemporaryFile(max_size=self.config['spoolsize'], dir=self.config['tempdir'])
+        try:
+            with closing(self.opener.open(package_url, timeout=remaining())) as resp:
+                if resp.getcode() != 200:
+                    raise Exception("Failed to download package from '{0}'".format(package_url))
+                # the timeout only bounds every read, the deadline is checked between them
+                while True:
+                    chunk = resp.read(1024 * 1024)
+                    if not chunk:
+                        break
+                    spool.write(chunk)
+                    remaining()
+        except:
+            spool.close()
+            raise
+        return spool
 
-            with closing(zipfile.ZipFile(temp_file, 'r')) as feed_zip:
-                feed_zip.extractall(self.config['tempdir'])
-                filename = os.path.join(self.config['tempdir'], feed_zip.namelist()[0])
-            os.remove(temp_file)
-            with open(filename) as f_in:
-                ret = json.load(f_in)
-            os.remove(filename)
-            return ret
+    def read_package(self, package):
+        with zipfile.ZipFile(package, 'r') as feed_zip:
+            with feed_zip.open(feed_zip.namelist()[0]) as member:
+                for attr in self.iter_json_array(io.TextIOWrapper(member, encoding='utf-8')):
+                    yield attr
 
 class FeedStats:
-    lock = threading.Lock()
-    feed_stats = {}
+    # Updates only touch a dict under a short lock; rendering and exporting
+    # is done by StatsReporter from its own thread.
+    metrics = [
+        ('count', 'iocs', 'IOCs parsed in the last run'),
+        ('upserted', 'upserted', 'Documents inserted in the last run'),
+        ('modified', 'modified', 'Documents modified in the last run'),
+        ('unchanged', 'unchanged', 'IOCs skipped because their fingerprint did not change'),
+        ('failed', 'failed', 'Documents that failed to load in the last run'),
+        ('bytes', 'download_bytes', 'Bytes downloaded in the last run'),
+        ('download_time', 'download_seconds', 'Time spent downloading in the last run'),
+        ('parse_time', 'parse_seconds', 'Time spent parsing in the last run'),
+        ('load_time', 'load_seconds', 'Time spent writing to mongodb in the last run'),
+        ('runtime', 'runtime_seconds', 'Wall clock time of the last run'),
+        ('rows_per_second', 'rows_per_second', 'IOCs parsed per second of the last run'),
+        ('dateparser', 'dateparser_fallbacks', 'Timestamps that needed dateparser in the last run'),
+        ('last_run', 'last_run_timestamp_seconds', 'End of the last run'),
+    ]
+
     def __init__(self):
+        self.lock = threading.Lock()
+        self.feed_stats = {}
         self.start = dt.now()
+        self.dirty = threading.Event()
+
+    def reset(self, feed):
+        with self.lock:
+            self.feed_stats[feed['name']] = {}
+        self.dirty.set()
 
     def set(self, feed, key, value):
-        self.lock.acquire()
-        try:
-            if not feed['name'] in self.feed_stats:
-                self.feed_stats[feed['name']] = {}
-            self.feed_stats[feed['name']][key] = value
-        finally:
-            self.lock.release()
+        with self.lock:
+            self.feed_stats.setdefault(feed['name'], {})[key] = value
+        self.dirty.set()
+
+    def add(self, feed, key, value):
+        with self.lock:
+            stats = self.feed_stats.setdefault(feed['name'], {})
+            stats[key] = stats.get(key, 0) + value
+        self.dirty.set()
+
+    def extend(self, feed, key, values, limit=None):
+        # limit caps the list over all calls of a run, not per call
+        with self.lock:
+            items = self.feed_stats.setdefault(feed['name'], {}).setdefault(key, [])
+            items.extend(values if limit is None else values[:max(0, limit - len(items))])
+        self.dirty.set()
 
     def get(self, feed, key):
-        self.lock.acquire()
-        try:
+        with self.lock:
             if feed['name'] in self.feed_stats:
-                if key in self.feed_stats[feed['name']]:
-                    return self.feed_stats[key]
+                return self.feed_stats[feed['name']].get(key)
             return None
-        finally:
-            self.lock.release()
-    
-    def out(self):
-        self.lock.acquire()
+
+    def snapshot(self):
+        with self.lock:
+            feed_stats = {name: dict(stats) for name, stats in self.feed_stats.items()}
+        now = dt.now()
+        for stats in feed_stats.values():
+            if 'start' in stats:
+                end = stats['end'] if stats.get('status') not in ('Running', 'Loading') else now
+                stats['runtime'] = (end - stats['start']).total_seconds()
+                stats['rows_per_second'] = stats.get('count', 0) / stats['runtime'] if stats['runtime'] > 0 else 0
+            if 'end' in stats and stats.get('status') not in ('Running', 'Loading'):
+                stats['last_run'] = stats['end'].timestamp()
+        return feed_stats
+
+    def render_terminal(self, feed_stats):
+        lines = []
+        sum_iocs = 0
+        for key, stats in sorted(feed_stats.items()):
+            if 'status' in stats and 'runtime' in stats:
+                runtime = str(td(seconds=int(stats['runtime'])))
+                stages = '%6.1f/%6.1f/%6.1f' % (stats.get('download_time', 0), stats.get('parse_time', 0), stats.get('load_time', 0))
+                lines.append('%-80s : %-10s : %10d : %10d : %10d : %10s : %20s : %s' % (key, stats['status'], stats.get('count', 0), stats.get('upserted', 0), stats.get('modified', 0), runtime, stages, stats.get('error', '')))
+                sum_iocs = sum_iocs + stats.get('count', 0)
+        total_runtime = str(dt.now() - self.start).split('.')[0]
+        lines.append('%-80s : %-10s : %10d : %10s : %10s : %10s : %20s : %s' % ('Total', '', sum_iocs, '', '', total_runtime, '', ''))
+        # clear the screen without forking a shell
+        sys.stdout.write('\033[H\033[2J' + '\n'.join(lines) + '\n')
+        sys.stdout.flush()
+
+    def write_json(self, feed_stats, path):
+        with open(path + '.tmp', 'w') as f:
+            json.dump({'start': self.start, 'feeds': feed_stats}, f, default=str, indent=2)
+        os.replace(path + '.tmp', path)
+
+    def write_prometheus(self, feed_stats, path):
+        escape = lambda value: str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        lines = []
+        for key, name, description in self.metrics:
+            lines.append('# HELP feedget_%s %s' % (name, description))
+            lines.append('# TYPE feedget_%s gauge' % name)
+            for feed, stats in sorted(feed_stats.items()):
+                if key in stats:
+                    lines.append('feedget_%s{feed="%s"} %s' % (name, escape(feed), float(stats[key])))
+        lines.append('# HELP feedget_status Current status of a feed')
+        lines.append('# TYPE feedget_status gauge')
+        for feed, stats in sorted(feed_stats.items()):
+            if 'status' in stats:
+                lines.append('feedget_status{feed="%s",status="%s"} 1' % (escape(feed), escape(stats['status'])))
+        with open(path + '.tmp', 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(path + '.tmp', path)
+
+class StatsReporter:
+    def __init__(self, feed_stats, config):
+        self.feed_stats = feed_stats
+        self.config = config
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def report(self):
+        self.feed_stats.dirty.clear()
+        feed_stats = self.feed_stats.snapshot()
+        if self.config.get('terminal'):
+            self.feed_stats.render_terminal(feed_stats)
+        if self.config.get('json'):
+            self.feed_stats.write_json(feed_stats, self.config['json'])
+        if self.config.get('prometheus'):
+            self.feed_stats.write_prometheus(feed_stats, self.config['prometheus'])
+
+    def run(self):
+        while not self.stopped.wait(self.config['interval']):
+            if self.feed_stats.dirty.is_set():
+                self.report()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        self.report()
+
+class FeedLeases:
+    # Time limited claims on feeds in the feedleases collection, so that
+    # feedget workers on several hosts share the feeds of one config.yml.
+    # Times are UTC to compare the leases of hosts in different time zones.
+    def __init__(self, col, duration):
+        self.col = col
+        self.duration = duration
+        self.owner = '%s:%d' % (socket.gethostname(), os.getpid())
+        self.held = {}
+        self.lost = set()
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def busy(self):
+        # names of feeds held by a live worker or not due yet, read once per
+        # tick so that claim is only tried on feeds which are likely free
+        now = dt.utcnow()
+        return set(lease['_id'] for lease in self.col.find({'$or': [{'expires': {'$gte': now}}, {'owner': None, 'nextRun': {'$gt': now}}]}, {'_id': 1}))
+
+    def claim(self, feed):
+        now = dt.utcnow()
+        free = {'$or': [{'owner': None}, {'expires': {'$lt': now}}]}
+        due = {'$or': [{'nextRun': None}, {'nextRun': {'$lte': now}}, {'expires': {'$lt': now}}]}
         try:
-            os.system('clear')
-            sum_iocs = 0
-            for key, stats in self.feed_stats.items():
-                if 'start' in stats and 'end' in stats and 'status' in stats and 'count' in stats and 'error' in stats:
-                    runtime = str(stats['end'] - stats['start']).split('.')[0]
-                    print('%-80s : %-10s : %10d : %10s : %s' % (key, stats['status'], stats['count'], runtime, stats['error']))
-                    sum_iocs = sum_iocs + stats['count']
-            total_runtime = str(dt.now()- self.start).split('.')[0]
-            print('%-80s : %-10s : %10d : %10s : %s' % ('Total', '', sum_iocs, total_runtime, ''))
-        finally:
-            self.lock.release()
+            # the upsert of a feed without a lease inserts it, for an existing lease it fails
+            self.col.find_one_and_update({'_id': feed['name'], '$and': [free, due]}, {'$set': {'owner': self.owner, 'expires': now + td(seconds=self.duration), 'claimed': now}}, upsert=True, return_document=ReturnDocument.AFTER)
+        except DuplicateKeyError:
+            return False
+        with self.lock:
+            self.held[feed['name']] = now
+            self.lost.discard(feed['name'])
+        return True
+
+    def release(self, feed, interval, status):
+        with self.lock:
+            claimed = self.held.pop(feed['name'])
+        self.col.update_one({'_id': feed['name'], 'owner': self.owner}, {'$set': {'owner': None, 'expires': None, 'nextRun': claimed + td(seconds=interval), 'lastStatus': status, 'lastRun': claimed}})
+
+    def renew(self):
+        with self.lock:
+            names = list(self.held)
+        if not names:
+            return
+        self.col.update_many({'_id': {'$in': names}, 'owner': self.owner}, {'$set': {'expires': dt.utcnow() + td(seconds=self.duration)}})
+        kept = set(lease['_id'] for lease in self.col.find({'_id': {'$in': names}, 'owner': self.owner}, {'_id': 1}))
+        with self.lock:
+            # taken over after our lease expired, the feed stops at its next check
+            self.lost.update(name for name in names if not name in kept and name in self.held)
+
+    def run(self):
+        while not self.stopped.wait(self.duration / 3):
+            try:
+                self.renew()
+            except Exception as e:
+                print(dt.now().strftime('%Y-%m-%d %H:%M:%S') + ' ERROR: Renewing leases failed: ' + str(e))
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+class MongoLoader:
+    max_failed_values = 100
+
+    def __init__(self, col, feed, feed_stats, bulksize, skip_unchanged, fingerprint_timestamp, feed_refs=None, queuesize=4):
+        self.col = col
+        self.feed = feed
+        # with the compact layout documents reference the feed's defaults
+        self.feed_refs = feed_refs
+        self.ref = feed_refs.register(feed) if feed_refs is not None else None
+        self.feed_stats = feed_stats
+        self.bulksize = bulksize
+        self.skip_unchanged = skip_unchanged
+        self.fingerprint_timestamp = fingerprint_timestamp
+        self.fingerprint_fields = [i for i, field in enumerate(IOC._fields) if fingerprint_timestamp or field != 'timestamp']
+        self.queue = queue.Queue(queuesize)
+        self.error = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def put(self, iocs):
+        for i in range(0, len(iocs), self.bulksize):
+            self.queue.put(iocs[i:i + self.bulksize])
+
+    def flush(self):
+        self.queue.join()
+        if self.error is not None:
+            raise self.error
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+    def run(self):
+        while True:
+            chunk = self.queue.get()
+            if chunk is None:
+                break
+            if self.error is None:
+                try:
+                    self.write(chunk)
+                except Exception as e:
+                    # keep draining the queue so that the producer never blocks
+                    self.error = e
+            self.queue.task_done()
+
+    def fingerprint(self, ioc):
+        values = [self.feed['url'], self.feed['provider']]
+        values.extend(ioc[i] for i in self.fingerprint_fields)
+        return hashlib.sha1(json.dumps(values).encode('utf-8')).hexdigest()
+
+    def changed(self, iocs):
+        # the IOCs to write with their fingerprints, and the unchanged ones
+        iocs = [(ioc, self.fingerprint(ioc)) for ioc in iocs]
+        if not self.skip_unchanged:
+            return iocs, []
+        start = time.perf_counter()
+        stored = {}
+        values = [ioc.value for ioc, _ in iocs]
+        if self.ref is not None:
+            for doc in self.col.find({'f': self.ref['_id'], 'v': {'$in': values}}, {'_id': 0, 'v': 1, 'fp': 1}):
+                stored[doc['v']] = doc.get('fp')
+        else:
+            for doc in self.col.find({'url': self.feed['url'], 'value': {'$in': values}}, {'_id': 0, 'value': 1, 'fingerprint': 1}):
+                stored[doc['value']] = doc.get('fingerprint')
+        changed = []
+        unchanged = []
+        for ioc, fingerprint in iocs:
+            if stored.get(ioc.value) != fingerprint:
+                changed.append((ioc, fingerprint))
+            else:
+                unchanged.append(ioc)
+        self.feed_stats.add(self.feed, 'load_time', time.perf_counter() - start)
+        self.feed_stats.add(self.feed, 'unchanged', len(unchanged))
+        return changed, unchanged
+
+    def touch(self, iocs, now):
+        # Feeds without a timestamp field stamp their IOCs with the time of
+        # the run, which is left out of the fingerprint. The unchanged ones
+        # still get it, with one update for the chunk, so that timestamp and
+        # modifyDate keep meaning last seen.
+        start = time.perf_counter()
+        values = [ioc.value for ioc in iocs]
+        timestamp = dt.fromtimestamp(max(ioc.timestamp for ioc in iocs))
+        if self.ref is not None:
+            self.col.update_many({'f': self.ref['_id'], 'v': {'$in': values}}, {'$set': {'ts': timestamp, 'md': now}})
+        else:
+            self.col.update_many({'url': self.feed['url'], 'value': {'$in': values}}, {'$set': {'timestamp': timestamp, 'modifyDate': now}})
+        self.feed_stats.add(self.feed, 'load_time', time.perf_counter() - start)
+
+    def document(self, ioc):
+        doc = ioc._asdict()
+        doc['timestamp'] = dt.fromtimestamp(ioc.timestamp)
+        doc['url'] = self.feed['url']
+        doc['provider'] = self.feed['provider']
+        return doc
+
+    def write(self, iocs):
+        iocs, unchanged = self.changed(iocs)
+        now = dt.now()
+        if unchanged and not self.fingerprint_timestamp:
+            self.touch(unchanged, now)
+        if not iocs:
+            return
+        requests = []
+        for ioc, fingerprint in iocs:
+            doc = self.document(ioc)
+            doc['fingerprint'] = fingerprint
+            doc['modifyDate'] = now
+            if self.ref is not None:
+                compact = self.feed_refs.compact(doc, self.ref)
+                update = {'$setOnInsert': {'cd': now}, '$set': compact}
+                # a value back at the feed's default must not leave the old one behind
+                omitted = self.feed_refs.omitted(compact)
+                if omitted:
+                    update['$unset'] = omitted
+                requests.append(UpdateOne({'v': ioc.value, 'f': self.ref['_id']}, update, upsert=True))
+            else:
+                requests.append(UpdateOne({'value': ioc.value, 'url': self.feed['url']}, {'$setOnInsert': {'createDate': now}, '$set': doc}, upsert=True))
+        failed = []
+        start = time.perf_counter()
+        try:
+            result = self.col.bulk_write(requests, ordered=False)
+            upserted = result.upserted_count
+            modified = result.modified_count
+        except BulkWriteError as e:
+            upserted = e.details['nUpserted']
+            modified = e.details['nModified']
+            failed = [iocs[error['index']][0].value for error in e.details['writeErrors']]
+        self.feed_stats.add(self.feed, 'load_time', time.perf_counter() - start)
+        self.feed_stats.add(self.feed, 'upserted', upserted)
+        self.feed_stats.add(self.feed, 'modified', modified)
+        if failed:
+            self.feed_stats.add(self.feed, 'failed', len(failed))
+            self.feed_stats.extend(self.feed, 'failed_values', failed, self.max_failed_values)
+            self.feed_stats.set(self.feed, 'error', 'Errors while loading to mongodb (' + str(self.feed_stats.get(self.feed, 'failed')) + ' failed)')
 
 class IOCReader:
     CONFIG_FILE = os.path.dirname(os.path.realpath(__file__)) + '/config.yml'
-    kasp_type_lookup = {
-            1: 'domain', 
-            2: 'domain', 
-            3: 'url',
-            4: 'url',
-            19: 'url',
-            20: 'url',
-            21: 'url',
-            22: 'url' 
-    }
-    re_ip = re.compile(r'\d+\.\d+\.\d+\.\d+')
+    chunksize = 65536
 
-
-    def __init__(self):
+    def __init__(self, config_file=None, coordinate=False):
+        if config_file is not None:
+            self.CONFIG_FILE = config_file
         self.read_config()
+        self.config_error = None
         mongo = MongoClient(self.config['mongo']['host'], self.config['mongo']['port'])
         self.db = mongo[self.config['mongo']['db']]
         self.col = self.db.iocs
+        self.feed_refs = FeedRefs(self.db) if self.config['general']['layout'] == 'compact' else None
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=self.config['general']['threads'], pool_maxsize=max(self.config['general']['threads'], self.config['general']['concurrency']))
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
         self.kaspersky_reader = KasperskyReader(self.config['kaspersky'])
         self.feed_stats = FeedStats()
+        self.loaders = {}
+        self.parsers = {}
+        self.deadlines = {}
+        self.stopped = threading.Event()
+        self.leases = None
+        if coordinate:
+            self.leases = FeedLeases(self.db.feedleases, self.config['general']['lease'])
+        self.process_pool = None
+        if self.config['general']['processes'] > 0:
+            # forkserver workers do not inherit the threads and sockets of this process
+            self.process_pool = ProcessPoolExecutor(self.config['general']['processes'], mp_context=multiprocessing.get_context('forkserver'))
    
     def log(self, msg, feed, sev='INFO'):
         timestamp = dt.now().strftime('%Y-%m-%d %H:%M:%S')
         print(timestamp + ' ' + sev +  ' [' + feed['name'] + ']:', msg)
 
     def read_config(self):
+        mtime = os.stat(self.CONFIG_FILE).st_mtime
         with open(self.CONFIG_FILE) as cf:
-           self.config = yaml.safe_load(cf)
-   
-    def create_ioc(self, feed, value, info, _type, timestamp, category, comment, _uuid, tags=[], link=None, to_ids=False):
-        obj = {}
-        obj['value'] = value
-        obj['info'] = info
-        obj['timestamp'] = dt.fromtimestamp(timestamp)
-        obj['category'] = category
-        obj['comment'] = comment
-        obj['type'] = _type
-        obj['uuid'] = _uuid
-        obj['to_ids'] = to_ids
-        obj['url'] = feed['url']
-        obj['link'] = link if link is not None else ''
-        obj['provider'] = feed['provider']
-        obj['tags'] = tags
-        #self.log('Found IOC: ' + obj['value'], feed)
-        return obj
+            config = yaml.safe_load(cf)
+        if not isinstance(config, dict) or not 'feeds' in config:
+            raise Exception('No feeds in ' + self.CONFIG_FILE)
+        self.config = config
+        self.config_mtime = mtime
 
-    def process_feed(self, feed):
-        #self.log("Processing feed ...", feed)
+    def reload_config(self):
+        # A config that can't be read (a syntax error, an editor replacing
+        # the file) is reported once, the daemon keeps the previous one.
+        try:
+            if os.stat(self.CONFIG_FILE).st_mtime == self.config_mtime:
+                return
+            kaspersky = self.config['kaspersky']
+            self.read_config()
+        except Exception as e:
+            if str(e) != self.config_error:
+                self.config_error = str(e)
+                print(dt.now().strftime('%Y-%m-%d %H:%M:%S') + ' ERROR: Reloading ' + self.CONFIG_FILE + ' failed, keeping the previous config: ' + str(e))
+            return
+        self.config_error = None
+        if self.config['kaspersky'] != kaspersky:
+            self.kaspersky_reader = KasperskyReader(self.config['kaspersky'])
+        # mongo, threads and processes are only read at startup
+        print(dt.now().strftime('%Y-%m-%d %H:%M:%S') + ' INFO: Reloaded ' + self.CONFIG_FILE)
+
+    def batchsize(self, feed):
+        return feed['batchsize'] if 'batchsize' in feed else self.config['general']['batchsize']
+
+    def timeout(self, feed):
+        return feed['timeout'] if 'timeout' in feed else self.config['general']['timeout']
+
+    def interval(self, feed):
+        return feed['interval'] if 'interval' in feed else self.config['general']['interval']
+
+    def remaining(self, feed):
+        # seconds left until the feed's deadline, raises FeedTimeout once it passed
+        if self.leases is not None and feed['name'] in self.leases.lost:
+            raise FeedTimeout('Lease lost to another worker')
+        remaining = self.deadlines[feed['name']] - time.monotonic()
+        if remaining <= 0:
+            raise FeedTimeout('Cancelled after ' + str(self.timeout(feed)) + 's')
+        return remaining
+
+    def bulksize(self, feed):
+        return feed['bulksize'] if 'bulksize' in feed else self.config['general']['bulksize']
+
+    def concurrency(self, feed):
+        return feed['concurrency'] if 'concurrency' in feed else self.config['general']['concurrency']
+
+    def incremental(self, feed):
+        return feed['incremental'] if 'incremental' in feed else self.config['general']['incremental']
+
+    def fetchcache(self, feed):
+        # csv feeds without a timestamp field stamp their IOCs with the time
+        # of the run, a 304 would leave them at the time of the last download
+        if feed['format'] == 'csv' and not 'timestampfield' in feed:
+            return False
+        return feed['fetchcache'] if 'fetchcache' in feed else self.config['general']['fetchcache']
+   
+    def start_feed(self, feed):
+        self.feed_stats.reset(feed)
         self.feed_stats.set(feed, 'start', dt.now())
         self.feed_stats.set(feed, 'end', dt.now())
         self.feed_stats.set(feed, 'status', 'Running')
         self.feed_stats.set(feed, 'error', '')
         self.feed_stats.set(feed, 'count', 0)
-        self.feed_stats.out()
-        if feed['format'] == 'kaspersky':
-            self.process_kaspersky_feed(feed)
-        elif feed['format'] == 'misp':
-            resp = requests.get(feed['url'] + '/manifest.json')
-            self.process_misp_feed(resp, feed)
-        elif feed['format'] == 'csv':
-            resp = requests.get(feed['url'], stream=True)
-            self.process_csv_feed(resp, feed)
-        #self.log("Feed finished.", feed)
-        self.feed_stats.set(feed, 'status', 'Finished')
-        self.feed_stats.set(feed, 'end', dt.now())
-        self.feed_stats.out()
+        for key in ['bytes', 'dateparser', 'download_time', 'parse_time', 'load_time']:
+            self.feed_stats.set(feed, key, 0)
+        fingerprint_timestamp = feed['format'] != 'csv' or 'timestampfield' in feed
+        self.loaders[feed['name']] = MongoLoader(self.col, feed, self.feed_stats, self.bulksize(feed), self.config['general']['skipunchanged'], fingerprint_timestamp, self.feed_refs)
+        self.parsers[feed['name']] = TimestampParser(feed['timestampformat'] if 'timestampformat' in feed else None)
+        self.deadlines[feed['name']] = time.monotonic() + self.timeout(feed)
 
-    def process_feeds(self):
+    def process_feed(self, feed):
+        self.process_feed_group([feed])
+
+    def process_feed_group(self, feeds):
+        # feeds of a group share the download of the first one, see feed_groups
+        feed = feeds[0]
+        #self.log("Processing feed ...", feed)
+        for member in feeds:
+            self.start_feed(member)
+        try:
+            if len(feeds) > 1:
+                self.process_csv_group(feeds)
+            elif feed['format'] == 'kaspersky':
+                self.process_kaspersky_feed(feed)
+            elif feed['format'] == 'misp':
+                resp = self.timed_call(feed, 'download', self.fetch, feed, feed['url'] + '/manifest.json')
+                self.process_misp_feed(resp, feed)
+                self.update_fetch_cache([feed], feed['url'] + '/manifest.json', resp)
+            elif feed['format'] == 'csv':
+                resp = self.timed_call(feed, 'download', self.fetch, feed, feed['url'], stream=True)
+                self.process_csv_feed(resp, feed)
+                self.update_fetch_cache([feed], feed['url'], resp)
+        except FeedUnchanged:
+            for feed in feeds:
+                self.feed_stats.set(feed, 'status', 'Unchanged')
+        except FeedTimeout as e:
+            for feed in feeds:
+                self.feed_stats.set(feed, 'status', 'Timeout')
+                self.feed_stats.set(feed, 'error', str(e))
+        except Exception as e:
+            for feed in feeds:
+                self.feed_stats.set(feed, 'status', 'Failed')
+                self.feed_stats.set(feed, 'error', str(e))
+        else:
+            #self.log("Feed finished.", feed)
+            for feed in feeds:
+                if self.feed_stats.get(feed, 'count') == 0:
+                    self.feed_stats.set(feed, 'error', 'No IOCs found')
+                self.feed_stats.set(feed, 'status', 'Finished')
+        finally:
+            for feed in feeds:
+                self.loaders.pop(feed['name']).close()
+                self.feed_stats.add(feed, 'dateparser', self.parsers.pop(feed['name']).fallbacks)
+                del self.deadlines[feed['name']]
+        for feed in feeds:
+            self.feed_stats.set(feed, 'end', dt.now())
+
+    def fetch(self, feed, url, group=None, **kwargs):
+        # group: the feeds sharing this download, feed when it is its own
+        headers = {}
+        if all(self.fetchcache(member) for member in group or [feed]):
+            cached = self.read_fetch_cache(self.fetch_key(group or [feed], url))
+            if 'etag' in cached:
+                headers['If-None-Match'] = cached['etag']
+            if 'lastModified' in cached:
+                headers['If-Modified-Since'] = cached['lastModified']
+        resp = self.session.get(url, headers=headers, timeout=self.remaining(feed), **kwargs)
+        if resp.status_code == 304:
+            resp.close()
+            raise FeedUnchanged()
+        return resp
+
+    def fetch_key(self, feeds, url):
+        # Validators are kept per feed, or per group of feeds sharing the
+        # download. Feeds with the same url that run separately (other
+        # intervals, other workers) must not take each other's 304.
+        return ','.join(sorted(feed['name'] for feed in feeds)) + ':' + url
+
+    def read_fetch_cache(self, key):
+        cached = self.db.fetchcache.find_one({'_id': key})
+        return cached if cached is not None else {}
+
+    def write_fetch_cache(self, key, validators):
+        validators['fetchDate'] = dt.now()
+        self.db.fetchcache.update_one({'_id': key}, {'$set': validators}, upsert=True)
+
+    def update_fetch_cache(self, feeds, url, resp):
+        # a member which failed to load must get the download again next time
+        if not all(self.fetchcache(feed) for feed in feeds) or resp.status_code != 200 or any(self.feed_stats.get(feed, 'error') for feed in feeds):
+            return
+        validators = {}
+        if 'ETag' in resp.headers:
+            validators['etag'] = resp.headers['ETag']
+        if 'Last-Modified' in resp.headers:
+            validators['lastModified'] = resp.headers['Last-Modified']
+        if validators:
+            self.write_fetch_cache(self.fetch_key(feeds, url), validators)
+
+    def enabled_feeds(self):
         feeds = []
         for feed in self.config['feeds']:
             if 'disabled' in feed and feed['disabled'] == True:
                 continue
             feeds.append(feed)
+        return feeds
+
+    def feed_groups(self, feeds):
+        # csv feeds reading the same source with the same layout of lines are
+        # downloaded and tokenized once, each of them mapping its own columns
+        groups = {}
+        for feed in feeds:
+            if feed['format'] == 'csv':
+                key = (feed['url'], feed['delimiter'] if 'delimiter' in feed else ',', 'ignorecsvheader' in feed and feed['ignorecsvheader'] == True)
+            else:
+                key = feed['name']
+            groups.setdefault(key, []).append(feed)
+        return list(groups.values())
+
+    def process_feeds(self):
+        feeds = self.enabled_feeds()
         if len(feeds) > 0:
             pool = ThreadPool(self.config['general']['threads'])
-            pool.map(self.process_feed, feeds)
+            pool.map(self.process_feed_group, self.feed_groups(feeds))
             pool.close() 
             pool.join()
-        self.feed_stats.out()
+
+    def process_leased_group(self, feeds):
+        try:
+            self.process_feed_group(feeds)
+        finally:
+            for feed in feeds:
+                try:
+                    self.leases.release(feed, self.interval(feed), self.feed_stats.get(feed, 'status'))
+                except Exception as e:
+                    # no longer renewed, the lease expires and the feed is claimed again
+                    self.log('Releasing the lease failed: ' + str(e), feed, 'ERROR')
+
+    def run_daemon(self):
+        threads = self.config['general']['threads']
+        pool = ThreadPool(threads)
+        next_runs = {}
+        running = set()
+        def finished(names):
+            return lambda result: running.difference_update(names)
+        try:
+            while not self.stopped.is_set():
+                self.reload_config()
+                now = time.monotonic()
+                due = []
+                try:
+                    busy = self.leases.busy() if self.leases is not None else None
+                    for feed in self.enabled_feeds():
+                        if feed['name'] in running:
+                            continue
+                        if self.leases is not None:
+                            # only claim what this worker can start now, the rest is left to others
+                            if feed['name'] in busy or len(running) >= threads or not self.leases.claim(feed):
+                                continue
+                        elif next_runs.get(feed['name'], 0) > now:
+                            continue
+                        running.add(feed['name'])
+                        next_runs[feed['name']] = now + self.interval(feed)
+                        due.append(feed)
+                except Exception as e:
+                    # e.g. a failover of mongodb: the feeds claimed so far run, the others are tried next tick
+                    print(dt.now().strftime('%Y-%m-%d %H:%M:%S') + ' ERROR: Claiming feeds failed: ' + str(e))
+                for feeds in self.feed_groups(due):
+                    names = [feed['name'] for feed in feeds]
+                    process = self.process_leased_group if self.leases is not None else self.process_feed_group
+                    pool.apply_async(process, (feeds,), callback=finished(names), error_callback=finished(names))
+                self.stopped.wait(1)
+        finally:
+            pool.close()
+            pool.join()
+            if self.leases is not None:
+                self.leases.stop()
+
+    def stop(self, *args):
+        self.stopped.set()
+
+    def close(self):
+        if self.process_pool is not None:
+            self.process_pool.shutdown()
+        self.session.close()
   
     def process_kaspersky_feed(self, feed):
-        iocs = []
-        attrs = self.kaspersky_reader.download_feed(feed['url'])
-        for attr in attrs:
-            if 'mask' in attr:
-                value = attr['mask']
-                _type = self.kasp_type_lookup[attr['type']]
-                _uuid = str(uuid.uuid4())
-                if _type == 'domain':
-                    if self.re_ip.match(value):
-                        _type = 'ip-dst'
-            info = feed['name']
-            timestamp = attr['last_seen'] if 'last_seen' in attr else attr['first_seen'] if 'first_seen' in attr else int(dt.now().strftime('%s'))
-            timestamp = self.convert_timestamp(timestamp, feed)
-            category = attr['category'].lower() if 'category' in attr else 'unknown'
-            comment = attr['threat'] if 'threat' in attr else attr['id']
-            tags = []
-            tags.append(category)
-            if 'mask' in attr:
-                ioc = self.create_ioc(feed, value, info, _type, timestamp, category, comment, _uuid, tags)
-                iocs.append(ioc)
-            else:
-                for key in ['MD5', 'SHA1', 'SHA256']:
-                    if key in attr:
-                        value = attr[key]
-                        _type = key.lower()
-                        _uuid = str(uuid.uuid4())
-                        ioc = self.create_ioc(feed, value, info, _type, timestamp, category, comment, _uuid, tags)
-                        iocs.append(ioc)
-        self.load_to_mongo(iocs, feed)
+        update = self.timed_call(feed, 'download', self.kaspersky_reader.latest_update, feed['url'], self.remaining(feed))
+        update_id = update['id'] if 'id' in update else update['packages'][0]['link']
+        if self.fetchcache(feed):
+            cached = self.read_fetch_cache(self.fetch_key([feed], feed['url']))
+            if cached.get('updateId') == update_id:
+                raise FeedUnchanged()
+        with self.timed_call(feed, 'download', self.kaspersky_reader.download_package, update, lambda: self.remaining(feed)) as package:
+            self.feed_stats.add(feed, 'bytes', package.tell())
+            package.seek(0)
+            attrs = self.timed(feed, 'parse', self.kaspersky_reader.read_package(package))
+            self.parse_batches(feed, parse_kaspersky_attrs, self.batches(attrs, self.batchsize(feed)), int(time.time()))
+        if self.fetchcache(feed) and not self.feed_stats.get(feed, 'error'):
+            self.write_fetch_cache(self.fetch_key([feed], feed['url']), {'updateId': update_id})
+
+    def fetch_misp_event(self, feed, key):
+        evt_resp = self.timed_call(feed, 'download', self.session.get, feed['url'] + '/' + key  + '.json', timeout=self.remaining(feed))
+        self.feed_stats.add(feed, 'bytes', len(evt_resp.content))
+        return self.parsed_iocs(feed, self.submit_parse(feed, parse_misp_event, evt_resp.text))
 
     def process_misp_feed(self, resp, feed):
+        batchsize = self.batchsize(feed)
         iocs = []
         manifest = json.loads(resp.text)
-        for key in manifest:
-            evt_resp = requests.get(feed['url'] + '/' + key  + '.json')
-            event = json.loads(evt_resp.text) 
-            if 'Attribute' in event['Event']:
-                for attr in event['Event']['Attribute']:
-                    value = attr['value']
-                    info = event['Event']['info']
-                    tags = []
-                    for tag in event['Event']['Tag']:
-                        tags.append(tag['name'])
-                    _type = attr['type']
-                    timestamp = attr['timestamp']
-                    timestamp = self.convert_timestamp(timestamp, feed)
-                    category = attr['category']
-                    comment = attr['comment']
-                    link = ''
-                    _uuid = attr['uuid']
-                    to_ids = attr['to_ids']
-                    ioc = self.create_ioc(feed, value, info, _type, timestamp, category, comment, _uuid, tags, link, to_ids)
-                    iocs.append(ioc)
+        state = {key: str(manifest[key]['timestamp']) for key in manifest if 'timestamp' in manifest[key]}
+        keys = list(manifest)
+        if self.incremental(feed):
+            synced = self.read_sync_state(feed)
+            keys = [key for key in keys if not key in state or synced.get(key) != state[key]]
+            if not keys:
+                raise FeedUnchanged()
+        pool = ThreadPool(self.concurrency(feed))
+        try:
+            for event_iocs in pool.imap_unordered(lambda key: self.fetch_misp_event(feed, key), keys):
+                iocs.extend(event_iocs)
+                if len(iocs) >= batchsize:
+                    self.load_to_mongo(iocs, feed)
+                    iocs = []
+        finally:
+            pool.close()
+            pool.join()
         self.load_to_mongo(iocs, feed)
+        self.flush_to_mongo(feed)
+        if self.incremental(feed) and not self.feed_stats.get(feed, 'error'):
+            self.write_sync_state(feed, state)
+
+    def read_sync_state(self, feed):
+        state = self.db.feedsync.find_one({'_id': feed['url']})
+        return state['events'] if state is not None else {}
+
+    def write_sync_state(self, feed, events):
+        self.db.feedsync.update_one({'_id': feed['url']}, {'$set': {'events': events, 'syncDate': dt.now()}}, upsert=True)
+
+    def csv_lines(self, resp, feed):
+        decoder = codecs.getincrementaldecoder(resp.encoding or 'utf-8')(errors='replace')
+        skip_header = 'ignorecsvheader' in feed and feed['ignorecsvheader'] == True
+        pending = ''
+        for chunk in self.timed(feed, 'download', resp.iter_content(self.chunksize)):
+            self.feed_stats.add(feed, 'bytes', len(chunk))
+            text = pending + decoder.decode(chunk)
+            lines = text.splitlines()
+            pending = lines.pop() if lines and not text.endswith(('\n', '\r')) else ''
+            for line in lines:
+                if line:
+                    if skip_header:
+                        skip_header = False
+                        continue
+                    if not line.startswith("#"):
+                        yield line
+        for line in (pending + decoder.decode(b'', True)).splitlines():
+            if line and not skip_header and not line.startswith("#"):
+                yield line
 
     def process_csv_feed(self, resp, feed):
-        delimiter = feed['delimiter'] if 'delimiter' in feed else ','
-        iocs = []
-        for line in resp.text.splitlines():
-            if line:
-                if 'ignorecsvheader' in feed and feed['ignorecsvheader'] == True:
-                    feed['ignorecsvheader'] = False
-                    continue
-                if not line.startswith("#"):
-                    line = re.sub(r'[\s]+', ' ', line) 
-                    fields = list(csv.reader([line], delimiter=delimiter))[0]
-                    value = fields[feed['valuefield']] if 'valuefield' in feed and len(fields) > feed['valuefield'] else fields[0]
-                    info = fields[feed['infofield']] if 'infofield' in feed and len(fields) > feed['infofield'] else feed['info'] if 'info' in feed else feed['name']
-                    _type = fields[feed['typefield']] if 'typefield' in feed and len(fields) > feed['typefield'] else feed['type'] if 'type' in feed else 'unknown'
-                    timestamp = fields[feed['timestampfield']] if 'timestampfield' in feed and len(fields) > feed['timestampfield'] else dt.now().strftime('%s')
-                    timestamp = self.convert_timestamp(timestamp, feed)
-                    category = fields[feed['categoryfield']] if 'categoryfield' in feed and len(fields) > feed['categoryfield'] else feed['category'] if 'category' in feed else 'unknown'
-                    comment = fields[feed['commentfield']] if 'commentfield' in feed and len(fields) > feed['commentfield'] else feed['comment'] if 'comment' in feed else 'unknown'
-                    link = fields[feed['linkfield']] if 'linkfield' in feed and len(fields) > feed['linkfield'] else feed['link'] if 'link' in feed else ''
-                    _uuid = str(uuid.uuid4())
-                    tags = feed['tags'] if 'tags' in feed else []
-                    ioc = self.create_ioc(feed, value, info, _type, timestamp, category, comment, _uuid, tags, link)
-                    iocs.append(ioc)
-        self.load_to_mongo(iocs, feed)
-    
-    def convert_timestamp(self, timestamp, feed):
-        if 'timestampformat' in feed:
-            if feed['timestampformat'] == '%sN':
-                timestamp = timestamp.split('.')[0]
-            else:
-                try: 
-                   timestamp = dt.strftime(dt.strptime(timestamp, feed['timestampformat']), '%s')
-                except ValueError as e:
-                    timestamp = dt.strftime(dateparser.parse(timestamp), '%s')
-        return int(timestamp)
+        self.parse_batches(feed, parse_csv_lines, self.batches(self.csv_lines(resp, feed), self.batchsize(feed)), int(time.time()))
+
+    def process_csv_group(self, feeds):
+        lead = feeds[0]
+        resp = self.timed_call(lead, 'download', self.fetch, lead, lead['url'], group=feeds, stream=True)
+        self.parse_fanout_batches(feeds, self.batches(self.csv_lines(resp, lead), self.batchsize(lead)), int(time.time()))
+        # every feed of the group got the whole download
+        for feed in feeds[1:]:
+            for key in ['bytes', 'download_time']:
+                self.feed_stats.set(feed, key, self.feed_stats.get(lead, key))
+        self.update_fetch_cache(feeds, lead['url'], resp)
+
+    def batches(self, iterable, size):
+        batch = []
+        for item in iterable:
+            batch.append(item)
+            if len(batch) >= size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def timed(self, feed, stage, iterable):
+        elapsed = 0
+        iterator = iter(iterable)
+        try:
+            while True:
+                self.remaining(feed)
+                start = time.perf_counter()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+                finally:
+                    elapsed += time.perf_counter() - start
+                yield item
+        finally:
+            self.feed_stats.add(feed, stage + '_time', elapsed)
+
+    def timed_call(self, feed, stage, func, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self.feed_stats.add(feed, stage + '_time', time.perf_counter() - start)
+
+    def submit_parse(self, feed, func, *args):
+        parser = self.parsers[feed['name']]
+        if self.process_pool is not None:
+            return self.process_pool.submit(run_parser, func, feed, parser, *args)
+        future = Future()
+        future.set_result(run_parser(func, feed, parser, *args))
+        return future
+
+    def parsed_iocs(self, feed, future):
+        return self.parsed(feed, future.result())
+
+    def parsed(self, feed, result):
+        iocs, elapsed, fallbacks = result
+        self.feed_stats.add(feed, 'parse_time', elapsed)
+        if self.process_pool is not None:
+            # the shared parser only counts the fallbacks of this process
+            self.feed_stats.add(feed, 'dateparser', fallbacks)
+        return iocs
+
+    def parse_batches(self, feed, func, batches, *args):
+        # With a process pool the next batches are downloaded while the
+        # previous ones are parsed; parsed IOCs go to mongodb in order.
+        pending = deque()
+        for batch in batches:
+            self.remaining(feed)
+            pending.append(self.submit_parse(feed, func, *args, batch))
+            if len(pending) > self.config['general']['processes']:
+                self.load_to_mongo(self.parsed_iocs(feed, pending.popleft()), feed)
+        while pending:
+            self.load_to_mongo(self.parsed_iocs(feed, pending.popleft()), feed)
+        self.flush_to_mongo(feed)
+
+    def submit_fanout(self, feeds, *args):
+        parsers = [self.parsers[feed['name']] for feed in feeds]
+        if self.process_pool is not None:
+            return self.process_pool.submit(parse_csv_fanout, feeds, parsers, *args)
+        future = Future()
+        future.set_result(parse_csv_fanout(feeds, parsers, *args))
+        return future
+
+    def load_fanout(self, feeds, future):
+        for feed, result in zip(feeds, future.result()):
+            self.load_to_mongo(self.parsed(feed, result), feed)
+
+    def parse_fanout_batches(self, feeds, batches, *args):
+        # parse_batches for a group of feeds sharing their lines
+        pending = deque()
+        for batch in batches:
+            self.remaining(feeds[0])
+            pending.append(self.submit_fanout(feeds, *args, batch))
+            if len(pending) > self.config['general']['processes']:
+                self.load_fanout(feeds, pending.popleft())
+        while pending:
+            self.load_fanout(feeds, pending.popleft())
+        for feed in feeds:
+            self.flush_to_mongo(feed)
 
     def load_to_mongo(self, iocs, feed):
         if len(iocs) > 0:
             #self.log("Loading to mongodb (" + str(len(iocs)) + " iocs)...", feed)
             self.feed_stats.set(feed, 'status', 'Loading')
-            self.feed_stats.set(feed, 'count', len(iocs))
+            self.feed_stats.add(feed, 'count', len(iocs))
             self.feed_stats.set(feed, 'end', dt.now())
-            self.feed_stats.out()
-            bulk = self.col.initialize_ordered_bulk_op()
-            now = dt.now()
-            for ioc in iocs:
-                obj = {}
-                obj['$setOnInsert'] = {}
-                obj['$setOnInsert']['createDate'] = now
-                ioc['modifyDate'] = now
-                obj['$set'] = ioc
-                bulk.find({'value': ioc['value']}).upsert().update_one(obj)
-            try:
-                bulk.execute()
-            except BulkWriteError as e:
-                self.feed_stats.set(feed, 'error', 'Errors while loading to mongodb')
-                self.feed_stats.out()
-                #self.log(e, feed, 'ERROR')
-                pass
-        else:
-            self.feed_stats.set(feed, 'error', 'No IOCs found')
-            self.feed_stats.out()
-            #self.log("Nothing to load to mongodb!", feed, 'ERROR')
-         
+            self.loaders[feed['name']].put(iocs)
+
+    def flush_to_mongo(self, feed):
+        self.loaders[feed['name']].flush()
+
 @timeout(1200)
 def main():
     iocreader = IOCReader()
-    iocreader.process_feeds()
+    reporter = StatsReporter(iocreader.feed_stats, iocreader.config['stats'])
+    try:
+        iocreader.process_feeds()
+    finally:
+        reporter.stop()
+        iocreader.close()
+
+def daemon(coordinate=False):
+    iocreader = IOCReader(coordinate=coordinate)
+    signal.signal(signal.SIGTERM, iocreader.stop)
+    signal.signal(signal.SIGINT, iocreader.stop)
+    reporter = StatsReporter(iocreader.feed_stats, iocreader.config['stats'])
+    try:
+        iocreader.run_daemon()
+    finally:
+        reporter.stop()
+        iocreader.close()
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Load IOC feeds into mongodb.')
+    parser.add_argument('-d', '--daemon', dest='daemon', action='store_true', help='Keep running and refresh every feed after its interval')
+    parser.add_argument('-c', '--coordinate', dest='coordinate', action='store_true', help='Run as a daemon sharing the feeds with other workers through leases in mongodb')
+    args = parser.parse_args()
     pid_file = os.path.dirname(os.path.realpath(__file__)) + '.pid'
     fp = open(pid_file, 'w')
     try:
-        fcntl.lockf(fp, fcntl.LOCK_EX | fcntl.LOCK_NB)
-        main()
+        # coordinated workers exclude each other through their leases
+        if not args.coordinate:
+            fcntl.lockf(fp, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        if args.daemon or args.coordinate:
+            daemon(args.coordinate)
+        else:
+            main()
     except IOError:
         print('Already running!')
         sys.exit(0)
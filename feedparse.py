@@ -0,0 +1,169 @@
+import re
+import csv
+import json
+import time
+import uuid
+import operator
+from collections import namedtuple
+
+# The parse functions of this module only depend on their arguments, so that
+# IOCReader can run them in worker processes as well as in its own threads.
+
+IOC = namedtuple('IOC', ['value', 'info', 'type', 'timestamp', 'category', 'comment', 'uuid', 'to_ids', 'link', 'tags'])
+
+kasp_type_lookup = {
+        1: 'domain',
+        2: 'domain',
+        3: 'url',
+        4: 'url',
+        19: 'url',
+        20: 'url',
+        21: 'url',
+        22: 'url'
+}
+re_ip = re.compile(r'\d+\.\d+\.\d+\.\d+')
+re_space = re.compile(r'[\s]+')
+
+def ioc_uuid(feed, value):
+    # stable per {value, url} so that an unchanged IOC keeps its fingerprint
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, feed['url'] + '#' + value))
+
+def create_ioc(feed, value, info, _type, timestamp, category, comment, _uuid, tags=[], link=None, to_ids=False):
+    return IOC(value, info, _type, timestamp, category, comment, _uuid, to_ids, link if link is not None else '', tags)
+
+row_mappers = {}
+
+def csv_column(feed, key, default):
+    # reads the column configured as <key>field, default for short rows or if there is none
+    if not key + 'field' in feed:
+        return lambda fields: default
+    index = int(feed[key + 'field'])
+    return lambda fields: fields[index] if len(fields) > index else default
+
+def csv_row_mapper(feed):
+    # The column layout of a csv feed as a function returning an IOC for a
+    # row of fields. It is kept per feed definition, so that threads and
+    # worker processes build it once instead of for every batch.
+    key = (feed['name'], json.dumps(feed, sort_keys=True, default=str))
+    if key in row_mappers:
+        return row_mappers[key]
+    tags = feed['tags'] if 'tags' in feed else []
+    info = csv_column(feed, 'info', feed['info'] if 'info' in feed else feed['name'])
+    _type = csv_column(feed, 'type', feed['type'] if 'type' in feed else 'unknown')
+    category = csv_column(feed, 'category', feed['category'] if 'category' in feed else 'unknown')
+    comment = csv_column(feed, 'comment', feed['comment'] if 'comment' in feed else 'unknown')
+    link = csv_column(feed, 'link', feed['link'] if 'link' in feed else '')
+    # rows without the timestamp column get the time of the run
+    timestamp = csv_column(feed, 'timestamp', None) if 'timestampfield' in feed else None
+    if 'valuefield' in feed:
+        index = int(feed['valuefield'])
+        value = lambda fields: fields[index] if len(fields) > index else fields[0]
+    else:
+        value = operator.itemgetter(0)
+    def map_row(fields, parse, now):
+        v = value(fields)
+        if timestamp is not None:
+            ts = timestamp(fields)
+            ts = parse(ts) if ts is not None else now
+        else:
+            ts = now
+        return IOC(v, info(fields), _type(fields), ts, category(fields), comment(fields), ioc_uuid(feed, v), False, link(fields), tags)
+    row_mappers[key] = map_row
+    return map_row
+
+def csv_rows(lines, delimiter):
+    # One reader tokenizes the whole batch. A quote that is never closed
+    # would make a row of all the lines after it, such rows are read again
+    # line by line like a reader per line did.
+    lines = [re_space.sub(' ', line) for line in lines]
+    reader = csv.reader(lines, delimiter=delimiter)
+    rows = []
+    line_num = 0
+    for fields in reader:
+        if reader.line_num - line_num > 1:
+            for line in lines[line_num:reader.line_num]:
+                rows.extend(csv.reader([line], delimiter=delimiter))
+        else:
+            rows.append(fields)
+        line_num = reader.line_num
+    return rows
+
+def parse_csv_lines(feed, parse, now, lines):
+    delimiter = feed['delimiter'] if 'delimiter' in feed else ','
+    map_row = csv_row_mapper(feed)
+    return [map_row(fields, parse, now) for fields in csv_rows(lines, delimiter)]
+
+def parse_csv_fanout(feeds, parses, now, lines):
+    # Feeds reading different columns of the same source share one
+    # tokenization of its lines. Returns what run_parser returns per feed,
+    # each charged an equal share of the tokenization time.
+    start = time.perf_counter()
+    delimiter = feeds[0]['delimiter'] if 'delimiter' in feeds[0] else ','
+    rows = csv_rows(lines, delimiter)
+    tokenize = (time.perf_counter() - start) / len(feeds)
+    results = []
+    for feed, parse in zip(feeds, parses):
+        start = time.perf_counter()
+        map_row = csv_row_mapper(feed)
+        iocs = [map_row(fields, parse, now) for fields in rows]
+        results.append((iocs, tokenize + time.perf_counter() - start, parse.fallbacks))
+    return results
+
+def parse_kaspersky_attrs(feed, parse, now, attrs):
+    iocs = []
+    for attr in attrs:
+        if 'mask' in attr:
+            value = attr['mask']
+            _type = kasp_type_lookup[attr['type']]
+            _uuid = ioc_uuid(feed, value)
+            if _type == 'domain':
+                if re_ip.match(value):
+                    _type = 'ip-dst'
+        info = feed['name']
+        timestamp = attr['last_seen'] if 'last_seen' in attr else attr['first_seen'] if 'first_seen' in attr else now
+        timestamp = parse(timestamp)
+        category = attr['category'].lower() if 'category' in attr else 'unknown'
+        comment = attr['threat'] if 'threat' in attr else attr['id']
+        tags = []
+        tags.append(category)
+        if 'mask' in attr:
+            ioc = create_ioc(feed, value, info, _type, timestamp, category, comment, _uuid, tags)
+            iocs.append(ioc)
+        else:
+            for key in ['MD5', 'SHA1', 'SHA256']:
+                if key in attr:
+                    value = attr[key]
+                    _type = key.lower()
+                    _uuid = ioc_uuid(feed, value)
+                    ioc = create_ioc(feed, value, info, _type, timestamp, category, comment, _uuid, tags)
+                    iocs.append(ioc)
+    return iocs
+
+def parse_misp_event(feed, parse, text):
+    iocs = []
+    event = json.loads(text)
+    if 'Attribute' in event['Event']:
+        info = event['Event']['info']
+        tags = []
+        for tag in event['Event']['Tag']:
+            tags.append(tag['name'])
+        for attr in event['Event']['Attribute']:
+            value = attr['value']
+            _type = attr['type']
+            timestamp = attr['timestamp']
+            timestamp = parse(timestamp)
+            category = attr['category']
+            comment = attr['comment']
+            link = ''
+            _uuid = attr['uuid']
+            to_ids = attr['to_ids']
+            ioc = create_ioc(feed, value, info, _type, timestamp, category, comment, _uuid, tags, link, to_ids)
+            iocs.append(ioc)
+    return iocs
+
+def run_parser(func, feed, parse, *args):
+    # Returns the IOCs together with the time spent parsing and the number
+    # of dateparser fallbacks of the (possibly pickled) timestamp parser.
+    start = time.perf_counter()
+    iocs = func(feed, parse, *args)
+    return iocs, time.perf_counter() - start, parse.fallbacks
@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+
+# The compact layout of the iocs collection (general.layout: compact).
+#
+# The url, provider and the defaults of a feed are stored once in the feeds
+# collection under a small id. IOC documents keep that id in 'f' and only
+# the fields which differ from the feed's defaults, all under short keys.
+# FeedRefs expands them back for readers, so queries and documents look the
+# same in both layouts. Existing collections are converted with
+#
+#   ./ioclayout.py compact [--swap]
+#   ./ioclayout.py full [--swap]
+
+import os
+import time
+import yaml
+import argparse
+import threading
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+from feedparse import ioc_uuid
+
+CONFIG_FILE = os.path.dirname(os.path.realpath(__file__)) + '/config.yml'
+
+SHORT_KEYS = {
+    'value': 'v',
+    'info': 'n',
+    'type': 't',
+    'timestamp': 'ts',
+    'category': 'c',
+    'comment': 'm',
+    'uuid': 'u',
+    'to_ids': 'i',
+    'link': 'l',
+    'tags': 'g',
+    'fingerprint': 'fp',
+    'modifyDate': 'md',
+    'createDate': 'cd',
+}
+LONG_KEYS = dict((short, key) for key, short in SHORT_KEYS.items())
+# fields left out of an IOC document while they equal the feed's
+DEFAULTS = ['info', 'category', 'comment', 'to_ids', 'link', 'tags']
+
+def feed_defaults(feed):
+    return {
+        'name': feed['name'],
+        'url': feed['url'],
+        'provider': feed['provider'] if 'provider' in feed else '',
+        'info': feed['info'] if 'info' in feed else feed['name'],
+        'category': feed['category'] if 'category' in feed else 'unknown',
+        'comment': feed['comment'] if 'comment' in feed else 'unknown',
+        'to_ids': False,
+        'link': feed['link'] if 'link' in feed else '',
+        'tags': feed['tags'] if 'tags' in feed else [],
+    }
+
+def matches(value, cond):
+    # the subset of mongo conditions FeedRefs.query translates, arrays match by element
+    values = value if isinstance(value, list) else [value]
+    if not isinstance(cond, dict):
+        return cond in values or cond == value
+    for op, arg in cond.items():
+        if op == '$in' and not any(v in arg for v in values):
+            return False
+        if op == '$nin' and any(v in arg for v in values):
+            return False
+        if op == '$eq' and not (arg in values or arg == value):
+            return False
+    return True
+
+class FeedRefs:
+    def __init__(self, db):
+        self.col = db.feeds
+        self.counters = db.counters
+        self.lock = threading.Lock()
+        self.refs = {}
+        self.indexed = False
+
+    def load(self):
+        with self.lock:
+            self.refs = dict((ref['_id'], ref) for ref in self.col.find())
+
+    def get(self, _id):
+        if not _id in self.refs:
+            self.load()
+        return self.refs[_id]
+
+    def register(self, feed):
+        # Returns the feed's reference, creating it with the next id if it is new
+        if not self.indexed:
+            self.col.create_index('name', unique=True)
+            self.indexed = True
+        defaults = feed_defaults(feed)
+        ref = self.col.find_one_and_update({'name': feed['name']}, {'$set': defaults}, return_document=ReturnDocument.AFTER)
+        while ref is None:
+            seq = self.counters.find_one_and_update({'_id': 'feeds'}, {'$inc': {'seq': 1}}, upsert=True, return_document=ReturnDocument.AFTER)['seq']
+            try:
+                defaults['_id'] = seq
+                self.col.insert_one(defaults)
+                ref = defaults
+            except DuplicateKeyError:
+                # registered by another thread meanwhile
+                del defaults['_id']
+                ref = self.col.find_one({'name': feed['name']})
+        with self.lock:
+            self.refs[ref['_id']] = ref
+        return ref
+
+    def compact(self, doc, ref):
+        compact = {'f': ref['_id']}
+        for key, value in doc.items():
+            if key in ('url', 'provider', '_id'):
+                continue
+            if key in DEFAULTS and ref[key] == value:
+                continue
+            if key == 'uuid' and value == ioc_uuid(ref, doc['value']):
+                continue
+            compact[SHORT_KEYS[key] if key in SHORT_KEYS else key] = value
+        return compact
+
+    def omitted(self, compact):
+        # short keys compact left out, to be unset in case an earlier write stored them
+        return dict((SHORT_KEYS[key], '') for key in DEFAULTS + ['uuid'] if not SHORT_KEYS[key] in compact)
+
+    def expand(self, doc):
+        # documents of the full layout pass unchanged
+        if not 'f' in doc:
+            return doc
+        ref = self.get(doc['f'])
+        full = {}
+        for key, value in doc.items():
+            if key != 'f':
+                full[LONG_KEYS[key] if key in LONG_KEYS else key] = value
+        for key in DEFAULTS:
+            if not key in full:
+                full[key] = list(ref[key]) if isinstance(ref[key], list) else ref[key]
+        full['url'] = ref['url']
+        full['provider'] = ref['provider']
+        if not 'uuid' in full and 'value' in full:
+            full['uuid'] = ioc_uuid(ref, full['value'])
+        return full
+
+    def query(self, query):
+        # Translates a query on full documents, conditions on url, provider
+        # and the defaults become conditions on the feed ids.
+        if not self.refs:
+            self.load()
+        compact = {}
+        alternatives = []
+        for key, cond in query.items():
+            if key in ('url', 'provider'):
+                ids = [ref['_id'] for ref in self.refs.values() if matches(ref[key], cond)]
+                compact['f'] = {'$in': ids} if not 'f' in compact else {'$in': [i for i in compact['f']['$in'] if i in ids]}
+            elif key in DEFAULTS:
+                ids = [ref['_id'] for ref in self.refs.values() if matches(ref[key], cond)]
+                # $nin and $ne would match documents without the field as well
+                stored = dict(cond, **{'$exists': True}) if isinstance(cond, dict) else cond
+                alternatives.append({'$or': [{SHORT_KEYS[key]: stored}, {SHORT_KEYS[key]: {'$exists': False}, 'f': {'$in': ids}}]})
+            else:
+                compact[SHORT_KEYS[key] if key in SHORT_KEYS else key] = cond
+        if alternatives:
+            compact['$and'] = alternatives
+        return compact
+
+    def projection(self, projection):
+        # defaults, url and provider come from the feed, so 'f' is always needed
+        compact = dict((SHORT_KEYS[key] if key in SHORT_KEYS else key, include) for key, include in projection.items() if not key in ('url', 'provider'))
+        if any(compact.values()):
+            compact['f'] = 1
+            if 'uuid' in projection:
+                compact['v'] = 1
+        return compact
+
+def create_indexes(col, layout):
+    if layout == 'compact':
+        col.create_index([('v', 1), ('f', 1)], unique=True)
+        for key in ['ts', 'md', 'cd', 't', 'f']:
+            col.create_index(key)
+    else:
+        col.create_index([('value', 1), ('url', 1)], unique=True)
+        for key in ['timestamp', 'modifyDate', 'createDate', 'type', 'provider']:
+            col.create_index(key)
+
+def migrate(config, layout, swap=False, batchsize=10000):
+    # Copies iocs to iocs_<layout> converting every document, and replaces
+    # iocs with the copy when swap is set.
+    from pymongo import MongoClient
+    client = MongoClient(config['mongo']['host'], config['mongo']['port'])
+    try:
+        db = client[config['mongo']['db']]
+        refs = FeedRefs(db)
+        by_url = {}
+        registered = {}
+        for feed in config['feeds']:
+            by_url.setdefault(feed['url'], []).append(feed)
+        target = db['iocs_' + layout]
+        target.drop()
+        start = time.perf_counter()
+        count = 0
+        batch = []
+        for doc in db.iocs.find():
+            doc = refs.expand(doc)
+            del doc['_id']
+            if layout == 'compact':
+                feeds = by_url.get(doc['url'], [])
+                # feeds sharing a url are told apart by their type
+                typed = [feed for feed in feeds if feed.get('type') == doc.get('type')]
+                feed = typed[0] if typed else feeds[0] if feeds else {'name': doc['url'], 'url': doc['url'], 'provider': doc.get('provider', '')}
+                if not feed['name'] in registered:
+                    registered[feed['name']] = refs.register(feed)
+                doc = refs.compact(doc, registered[feed['name']])
+            batch.append(doc)
+            if len(batch) >= batchsize:
+                target.insert_many(batch, ordered=False)
+                count += len(batch)
+                batch = []
+        if batch:
+            target.insert_many(batch, ordered=False)
+            count += len(batch)
+        create_indexes(target, layout)
+        print('%s INFO: Copied %d IOCs to %s in %.1fs' % (time.strftime('%Y-%m-%d %H:%M:%S'), count, target.name, time.perf_counter() - start))
+        if swap:
+            target.rename('iocs', dropTarget=True)
+            print('%s INFO: Replaced iocs with %s, set general.layout to %s' % (time.strftime('%Y-%m-%d %H:%M:%S'), target.name, layout))
+    finally:
+        client.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Convert the iocs collection to another layout.')
+    parser.add_argument('layout', type=str, choices=['compact', 'full'], help='The layout to convert to')
+    parser.add_argument('-c', '--config', dest='config', type=str, default=CONFIG_FILE, help='The feedget configuration')
+    parser.add_argument('--swap', dest='swap', action='store_true', help='Replace iocs with the converted copy')
+    args = parser.parse_args()
+    with open(args.config) as cf:
+        config = yaml.safe_load(cf)
+    migrate(config, args.layout, args.swap)
@@ -0,0 +1,359 @@
+#!/usr/bin/env python3
+
+# Matches observables from proxy or DNS logs against the IOCs feedget.py
+# stores, using a snapshot of the iocs collection in a memory-mapped file.
+#
+#   ./iocmatch.py --refresh                    # bring the snapshot up to date
+#   ./iocmatch.py -o matches.json proxy.log dns.log
+#   cut -f3 dns.log | ./iocmatch.py --refresh
+
+import os
+import re
+import sys
+import json
+import mmap
+import time
+import yaml
+import struct
+import hashlib
+import argparse
+import ipaddress
+import multiprocessing
+from datetime import datetime as dt
+from urllib.parse import urlsplit
+
+CONFIG_FILE = os.path.dirname(os.path.realpath(__file__)) + '/config.yml'
+MAGIC = b'IOCSNAP1'
+SLOT = struct.Struct('<QQ')
+LENGTH = struct.Struct('<I')
+HASH = struct.Struct('<Q')
+
+hash_types = set(['md5', 'sha1', 'sha224', 'sha256', 'sha384', 'sha512'])
+url_types = set(['url', 'link', 'uri'])
+domain_types = set(['domain', 'hostname'])
+ip_types = set(['ip-src', 'ip-dst'])
+re_hash = re.compile(r'^[0-9a-fA-F]{32}([0-9a-fA-F]{8}|[0-9a-fA-F]{24}|[0-9a-fA-F]{32}|[0-9a-fA-F]{64}|[0-9a-fA-F]{96})?$')
+
+def key_hash(key):
+    # 0 marks an empty slot
+    return HASH.unpack(hashlib.blake2b(key.encode('utf-8'), digest_size=8).digest())[0] or 1
+
+def reversed_labels(domain):
+    return '.'.join(reversed(domain.lower().rstrip('.').split('.')))
+
+def normalize_url(value):
+    # without the scheme and with the host in lower case, so that feeds
+    # listing urls without a scheme (Kaspersky masks) match logged urls
+    if '://' in value:
+        value = value.split('://', 1)[1]
+    host, sep, path = value.partition('/')
+    return host.lower() + sep + path
+
+def ioc_key(ioc):
+    # The partition and key an IOC is indexed under, and the network for CIDR ranges
+    value = ioc['value']
+    if ioc['type'] in hash_types:
+        return 'hash:' + value.lower(), None
+    if ioc['type'] in url_types:
+        return 'url:' + normalize_url(value), None
+    if ioc['type'] in domain_types:
+        return 'domain:' + reversed_labels(value), None
+    if ioc['type'] in ip_types:
+        try:
+            network = ipaddress.ip_network(value, strict=False)
+        except ValueError:
+            return 'value:' + value, None
+        if network.num_addresses == 1:
+            return 'ip:' + str(network.network_address), None
+        net = (network.version, network.prefixlen)
+        return 'net:%d:%d:%d' % (net[0], net[1], int(network.network_address)), net
+    return 'value:' + value, None
+
+def ioc_meta(doc):
+    return {
+        'value': doc['value'],
+        'type': doc['type'],
+        'category': doc.get('category'),
+        'info': doc.get('info'),
+        'comment': doc.get('comment'),
+        'tags': doc.get('tags', []),
+        'provider': doc.get('provider'),
+        'url': doc['url'],
+        'timestamp': int(time.mktime(doc['timestamp'].timetuple())) if isinstance(doc.get('timestamp'), dt) else doc.get('timestamp'),
+    }
+
+class SnapshotWriter:
+    # Collects the IOCs per key and writes them as an open addressing hash
+    # table of (key hash, record offset) slots followed by the records.
+    def __init__(self):
+        self.records = {}
+        self.keys = {}
+        self.nets = set()
+        self.watermark = None
+
+    def load(self, snapshot):
+        # starts from the records of an existing snapshot, keyed again in
+        # case the keys changed since it was written
+        for key, metas in snapshot.records():
+            for meta in metas:
+                self.add(meta)
+        self.watermark = snapshot.header['watermark']
+
+    def add(self, meta, key=None, net=None):
+        ident = (meta['value'], meta['url'])
+        if key is None:
+            key, net = ioc_key(meta)
+            if net is not None:
+                self.nets.add(net)
+        # an updated IOC replaces its previous version, wherever that was indexed
+        if ident in self.keys:
+            previous = self.keys[ident]
+            self.records[previous] = [m for m in self.records[previous] if (m['value'], m['url']) != ident]
+            if not self.records[previous]:
+                del self.records[previous]
+        self.records.setdefault(key, []).append(meta)
+        self.keys[ident] = key
+
+    def write(self, path):
+        slots = 1024
+        while slots < len(self.records) * 2:
+            slots *= 2
+        partitions = sorted(set(key.split(':', 1)[0] for key in self.records))
+        header = json.dumps({'slots': slots, 'partitions': partitions, 'nets': sorted(self.nets), 'watermark': self.watermark, 'keys': len(self.records), 'iocs': len(self.keys)}).encode('utf-8')
+        table_offset = (len(MAGIC) + LENGTH.size + len(header) + 7) // 8 * 8
+        offset = table_offset + slots * SLOT.size
+        table = bytearray(slots * SLOT.size)
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(MAGIC + LENGTH.pack(len(header)) + header)
+            f.seek(offset)
+            for key, metas in self.records.items():
+                record = json.dumps({'key': key, 'iocs': metas}).encode('utf-8')
+                h = key_hash(key)
+                slot = h & (slots - 1)
+                while SLOT.unpack_from(table, slot * SLOT.size)[0]:
+                    slot = (slot + 1) & (slots - 1)
+                SLOT.pack_into(table, slot * SLOT.size, h, offset)
+                f.write(LENGTH.pack(len(record)) + record)
+                offset += LENGTH.size + len(record)
+            f.seek(table_offset)
+            f.write(table)
+        # readers keep the mapping of the old file until they reopen
+        os.replace(tmp, path)
+
+class Snapshot:
+    def __init__(self, path):
+        self.file = open(path, 'rb')
+        self.mm = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.mm[:len(MAGIC)] != MAGIC:
+            raise ValueError(path + ' is not an IOC snapshot')
+        length = LENGTH.unpack_from(self.mm, len(MAGIC))[0]
+        start = len(MAGIC) + LENGTH.size
+        self.header = json.loads(self.mm[start:start + length].decode('utf-8'))
+        self.slots = self.header['slots']
+        self.table_offset = (start + length + 7) // 8 * 8
+        # longest prefix first, like a routing table
+        self.nets = sorted([tuple(net) for net in self.header['nets']], key=lambda net: -net[1])
+        # partitions without any IOC are not probed at all
+        self.partitions = set(self.header['partitions'])
+
+    def close(self):
+        self.mm.close()
+        self.file.close()
+
+    def record(self, offset):
+        length = LENGTH.unpack_from(self.mm, offset)[0]
+        return json.loads(self.mm[offset + LENGTH.size:offset + LENGTH.size + length].decode('utf-8'))
+
+    def records(self):
+        for slot in range(self.slots):
+            h, offset = SLOT.unpack_from(self.mm, self.table_offset + slot * SLOT.size)
+            if h:
+                record = self.record(offset)
+                yield record['key'], record['iocs']
+
+    def get(self, key):
+        h = key_hash(key)
+        slot = h & (self.slots - 1)
+        while True:
+            stored, offset = SLOT.unpack_from(self.mm, self.table_offset + slot * SLOT.size)
+            if not stored:
+                return None
+            if stored == h:
+                record = self.record(offset)
+                if record['key'] == key:
+                    return record['iocs']
+            slot = (slot + 1) & (self.slots - 1)
+
+    def ip_keys(self, value):
+        if not value[0].isdigit() and not ':' in value:
+            return None
+        try:
+            ip = ipaddress.ip_address(value)
+        except ValueError:
+            return None
+        keys = ['ip:' + str(ip)]
+        for version, prefixlen in self.nets:
+            if version == ip.version:
+                bits = ip.max_prefixlen
+                keys.append('net:%d:%d:%d' % (version, prefixlen, int(ip) >> (bits - prefixlen) << (bits - prefixlen)))
+        return keys
+
+    def domain_keys(self, value):
+        labels = value.lower().rstrip('.').split('.')
+        # every parent domain down to the tld, e.g. com, example.com, www.example.com
+        return ['domain:' + '.'.join(reversed(labels[i:])) for i in range(len(labels) - 1, -1, -1)]
+
+    def keys(self, value):
+        keys = ['value:' + value]
+        if re_hash.match(value):
+            keys.append('hash:' + value.lower())
+            return keys
+        host = value
+        if '://' in value or '/' in value:
+            keys.append('url:' + normalize_url(value))
+            try:
+                host = urlsplit(value if '://' in value else '//' + value).hostname
+            except ValueError:
+                host = None
+            if not host:
+                return keys
+        ip_keys = self.ip_keys(host)
+        if ip_keys is not None:
+            keys.extend(ip_keys)
+        elif '.' in host:
+            keys.extend(self.domain_keys(host))
+        return keys
+
+    def match(self, value):
+        matches = []
+        for key in self.keys(value):
+            if not key.split(':', 1)[0] in self.partitions:
+                continue
+            iocs = self.get(key)
+            if iocs:
+                matches.extend(iocs)
+        return matches
+
+snapshot = None
+
+def init_worker(path):
+    global snapshot
+    snapshot = Snapshot(path)
+
+def match_lines(lines):
+    out = []
+    for line in lines:
+        value = line.strip()
+        if not value:
+            continue
+        matches = snapshot.match(value)
+        if matches:
+            out.append(json.dumps({'observable': value, 'matches': matches}))
+    return out
+
+def read_config(config_file):
+    with open(config_file) as cf:
+        return yaml.safe_load(cf)
+
+def refresh(config, path, rebuild=False):
+    # Adds the IOCs modified since the snapshot was taken, or all of them
+    from pymongo import MongoClient
+    writer = SnapshotWriter()
+    if not rebuild and os.path.exists(path):
+        old = Snapshot(path)
+        try:
+            writer.load(old)
+        finally:
+            old.close()
+    client = MongoClient(config['mongo']['host'], config['mongo']['port'])
+    try:
+        db = client[config['mongo']['db']]
+        query = {}
+        if writer.watermark is not None:
+            # modifyDate is taken before a bulk write commits, and feeds write
+            # concurrently: a chunk stamped earlier may become visible after
+            # a later one was read. IOCs modified up to lag seconds before the
+            # watermark are read again.
+            query['modifyDate'] = {'$gte': dt.fromtimestamp(writer.watermark - config['match']['lag'])}
+        projection = {'_id': 0, 'value': 1, 'type': 1, 'category': 1, 'info': 1, 'comment': 1, 'tags': 1, 'provider': 1, 'url': 1, 'timestamp': 1, 'modifyDate': 1}
+        expand = lambda doc: doc
+        if config['general']['layout'] == 'compact':
+            from ioclayout import FeedRefs
+            feed_refs = FeedRefs(db)
+            query = feed_refs.query(query)
+            projection = feed_refs.projection(projection)
+            expand = feed_refs.expand
+        count = 0
+        watermark = writer.watermark
+        for doc in db.iocs.find(query, projection, batch_size=int(config['match']['batchsize'])):
+            doc = expand(doc)
+            writer.add(ioc_meta(doc))
+            if 'modifyDate' in doc:
+                modified = time.mktime(doc['modifyDate'].timetuple()) + doc['modifyDate'].microsecond / 1e6
+                watermark = modified if watermark is None else max(watermark, modified)
+            count += 1
+    finally:
+        client.close()
+    writer.watermark = watermark
+    writer.write(path)
+    return count, len(writer.keys)
+
+def chunks(files, chunksize):
+    chunk = []
+    for f in files:
+        for line in f:
+            chunk.append(line)
+            if len(chunk) >= chunksize:
+                yield chunk
+                chunk = []
+    if chunk:
+        yield chunk
+
+def main():
+    parser = argparse.ArgumentParser(description='Match observables against a snapshot of the IOC collection.')
+    parser.add_argument('inputs', type=str, nargs='*', help='Files with one observable per line, default is stdin')
+    parser.add_argument('-c', '--config', dest='config', type=str, default=CONFIG_FILE, help='The feedget configuration with the mongo settings')
+    parser.add_argument('-s', '--snapshot', dest='snapshot', type=str, default=None, help='The snapshot file, default is match.snapshot of the configuration')
+    parser.add_argument('-o', '--output', dest='output', type=str, default=None, help='Write the matches to this file instead of stdout')
+    parser.add_argument('-w', '--workers', dest='workers', type=int, default=None, help='Number of worker processes, default is match.workers of the configuration')
+    parser.add_argument('--refresh', dest='refresh', action='store_true', help='Add IOCs modified since the snapshot was taken before matching')
+    parser.add_argument('--rebuild', dest='rebuild', action='store_true', help='Build the snapshot from scratch before matching')
+    args = parser.parse_args()
+
+    config = read_config(args.config)
+    path = args.snapshot if args.snapshot else config['match']['snapshot']
+    workers = args.workers if args.workers is not None else config['match']['workers']
+    if args.refresh or args.rebuild or not os.path.exists(path):
+        start = time.perf_counter()
+        count, total = refresh(config, path, args.rebuild)
+        sys.stderr.write('%s INFO: Read %d IOCs in %.2fs, snapshot has %d\n' % (dt.now().strftime('%Y-%m-%d %H:%M:%S'), count, time.perf_counter() - start, total))
+        if not args.inputs and sys.stdin.isatty():
+            return
+
+    files = [open(name) for name in args.inputs] if args.inputs else [sys.stdin]
+    out = open(args.output, 'w') if args.output else sys.stdout
+    try:
+        if workers > 0:
+            pool = multiprocessing.Pool(workers, initializer=init_worker, initargs=(path,))
+            try:
+                for lines in pool.imap(match_lines, chunks(files, config['match']['chunksize'])):
+                    for line in lines:
+                        out.write(line + '\n')
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            init_worker(path)
+            for lines in chunks(files, config['match']['chunksize']):
+                for line in match_lines(lines):
+                    out.write(line + '\n')
+    finally:
+        if args.output:
+            out.close()
+        for f in files:
+            if f is not sys.stdin:
+                f.close()
+
+if __name__ == "__main__":
+    main()
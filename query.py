@@ -1,15 +1,27 @@
 #! /usr/bin/env python3
 
-import pymisp
+import sys
+import os
 import logging
 import json
 import warnings
 import argparse
 import configparser
-import re, math
 from datetime import datetime as dt, timedelta as td
 import pprint
 import traceback
+import sqlite3
+import time
+import queue
+import threading
+import signal
+import socket
+import socketserver
+from contextlib import closing
+from collections import OrderedDict
+from multiprocessing.dummy import Pool as ThreadPool
+from queryplan import SEP, QueryPlan
+from queryoutput import RowWriter
 
 
 warnings.filterwarnings("ignore")
@@ -17,9 +29,6 @@ warnings.filterwarnings("ignore")
 config = configparser.ConfigParser()
 config.read('config.ini')
 
-SEP = '|'
-SEVERITY=['n/a','informational','low','medium','high','critical']
-
 def datebefore(days):
     now = dt.now()
     return (now - td(days=days)).replace(hour=0, minute=0, second=0, microsecond=0).strftime('%Y-%m-%d')
@@ -30,36 +39,55 @@ def yesterday():
 def today():
     return datebefore(0)
 
-parser = argparse.ArgumentParser(description='Query the MISP plattform.')
-parser.add_argument('-c', '--controller', dest='controller', type=str, default='attributes', help='The controller to use', choices=['attributes', 'events'])
-parser.add_argument('-t', '--type', dest='type', type=str, default=None, help='The attribute type to query', choices=['ip-src', 'ip-dst', 'domain', 'url', 'md5', 'sha1', 'sha256', 'link'])
-parser.add_argument('-o', '--org', dest='org', type=str, default=None, help='The organization to query')
-parser.add_argument('-l', '--last', dest='last', type=str, default=None, help='Only show events publishe in the last n<timeinterval>')
-parser.add_argument('--day-range', dest='day_range', type=int, default=None, help='Sets date-from to now - n days')
-parser.add_argument('--date-from', dest='date_from', type=str, default=yesterday(), help='From this date on, only if --day-range is not set')
-parser.add_argument('--date-to', dest='date_to', type=str, default=today(), help='Up to this date, only if --day-range is not set')
-parser.add_argument('--tags', dest='tags', type=str, default=None, help='Tags to search for')
-parser.add_argument('--not-tags', dest='not_tags', type=str, default=None, help='Tags not to search for')
-parser.add_argument('--eventid', dest='eventid', type=str, default=None, help='The eventid to search for')
-parser.add_argument('--out-key', dest='out_keys', type=str, nargs='+', default=config['output']['keys'].split(','), help='The keys to output')
-parser.add_argument('--out-sep', dest='out_sep', type=str, default=config['output']['separator'], help='The separator for the output of multiple keys')
-parser.add_argument('--idx-col', dest='idx_col', type=str, default=config['output']['idxcol'], help='The index column (should be value)')
-parser.add_argument('--max-cols', dest='max_cols', type=str, default=config['output']['maxcols'].split(','), help='Cols where we store the max value')
-parser.add_argument('--mv-cols', dest='mv_cols', type=str, default=config['output']['mvcols'].split(','), help='Cols where we store multi values separated by ' + SEP)
-parser.add_argument('--mv-dist-cols', dest='mv_dist_cols', type=str, default=config['output']['mvdistcols'].split(','), help='Cols where we store distinct multi values separated by ' + SEP)
-parser.add_argument('--comment-fields', dest='comment_fields', type=str, default=config['output']['commentfields'].split(','), help='Fields to extract from key-value paires in the comment field')
-parser.add_argument('--severity-boost-tags', dest='severity_boost_tags', type=str, default=config['output']['severityboosttags'].split(','), help='Tags to boost severity')
-parser.add_argument('--tags-field', dest='tags_field', type=str, default=config['output']['tagsfield'], help='The field where tags as stored')
-parser.add_argument('--tags-to-category', dest='tags_to_category', type=str, default=config['output']['tagstocategory'].split(','), help='List of regular expressions in tags to match a category')
-parser.add_argument('--tags-to-severity', dest='tags_to_severity', type=str, default=config['output']['tagstoseverity'].split(','), help='List of regular expressions in tags to match a severity')
-args = parser.parse_args()
-
-if args.day_range:
-    args.date_from = datebefore(args.day_range)
-    args.date_to = today()
-
-logger = logging.getLogger('pymisp')
-logging.basicConfig(level=logging.DEBUG, filename="debug.log", filemode='w', format=pymisp.FORMAT)
+def build_parser():
+    # parsed by the client, a server only gets the resulting arguments
+    parser = argparse.ArgumentParser(description='Query the MISP plattform.')
+    parser.add_argument('-c', '--controller', dest='controller', type=str, default='attributes', help='The controller to use', choices=['attributes', 'events'])
+    parser.add_argument('-t', '--type', dest='type', type=str, default=None, help='The attribute type to query', choices=['ip-src', 'ip-dst', 'domain', 'url', 'md5', 'sha1', 'sha256', 'link'])
+    parser.add_argument('-o', '--org', dest='org', type=str, default=None, help='The organization to query')
+    parser.add_argument('-l', '--last', dest='last', type=str, default=None, help='Only show events publishe in the last n<timeinterval>')
+    parser.add_argument('--day-range', dest='day_range', type=int, default=None, help='Sets date-from to now - n days')
+    parser.add_argument('--date-from', dest='date_from', type=str, default=yesterday(), help='From this date on, only if --day-range is not set')
+    parser.add_argument('--date-to', dest='date_to', type=str, default=today(), help='Up to this date, only if --day-range is not set')
+    parser.add_argument('--tags', dest='tags', type=str, default=None, help='Tags to search for')
+    parser.add_argument('--not-tags', dest='not_tags', type=str, default=None, help='Tags not to search for')
+    parser.add_argument('--eventid', dest='eventid', type=str, default=None, help='The eventid to search for')
+    parser.add_argument('--out-key', dest='out_keys', type=str, nargs='+', default=config['output']['keys'].split(','), help='The keys to output')
+    parser.add_argument('--out-sep', dest='out_sep', type=str, default=config['output']['separator'], help='The separator for the output of multiple keys')
+    parser.add_argument('--idx-col', dest='idx_col', type=str, default=config['output']['idxcol'], help='The index column (should be value)')
+    parser.add_argument('--max-cols', dest='max_cols', type=str, default=config['output']['maxcols'].split(','), help='Cols where we store the max value')
+    parser.add_argument('--mv-cols', dest='mv_cols', type=str, default=config['output']['mvcols'].split(','), help='Cols where we store multi values separated by ' + SEP)
+    parser.add_argument('--mv-dist-cols', dest='mv_dist_cols', type=str, default=config['output']['mvdistcols'].split(','), help='Cols where we store distinct multi values separated by ' + SEP)
+    parser.add_argument('--comment-fields', dest='comment_fields', type=str, default=config['output']['commentfields'].split(','), help='Fields to extract from key-value paires in the comment field')
+    parser.add_argument('--severity-boost-tags', dest='severity_boost_tags', type=str, default=config['output']['severityboosttags'].split(','), help='Tags to boost severity')
+    parser.add_argument('--tags-field', dest='tags_field', type=str, default=config['output']['tagsfield'], help='The field where tags as stored')
+    parser.add_argument('--tags-to-category', dest='tags_to_category', type=str, default=config['output']['tagstocategory'].split(','), help='List of regular expressions in tags to match a category')
+    parser.add_argument('--tags-to-severity', dest='tags_to_severity', type=str, default=config['output']['tagstoseverity'].split(','), help='List of regular expressions in tags to match a severity')
+    parser.add_argument('--slice-days', dest='slice_days', type=int, default=int(config['search']['slicedays']), help='Split the date range into slices of n days searched separately, 0 searches it at once')
+    parser.add_argument('--page-size', dest='page_size', type=int, default=int(config['search']['pagesize']), help='Page through each search with this many attributes per request, 0 disables paging')
+    parser.add_argument('--workers', dest='workers', type=int, default=int(config['search']['workers']), help='The number of slices searched concurrently')
+    parser.add_argument('--backend', dest='backend', type=str, default=config['search']['backend'], help='Search MISP or the IOC collection feedget.py keeps in Mongo', choices=['misp', 'mongo'])
+    parser.add_argument('--no-aggregate', dest='aggregate', action='store_false', default=config['output'].getboolean('aggregate', fallback=True), help='Write a row for every attribute as soon as it is projected instead of aggregating them by --idx-col')
+    parser.add_argument('--gzip', dest='gzip', action='store_true', default=config['output'].getboolean('gzip', fallback=False), help='Compress the output with gzip')
+    parser.add_argument('--serve', dest='serve', action='store_true', help='Keep running and answer queries on the socket configured in [server]')
+    parser.add_argument('--local', dest='local', action='store_true', help='Run the query in this process even if a server is running')
+    return parser
+
+def parse_args(argv=None):
+    args = build_parser().parse_args(argv)
+    if args.day_range:
+        args.date_from = datebefore(args.day_range)
+        args.date_to = today()
+    return args
+
+def setup_logging():
+    # pymisp is only imported by processes which talk to MISP, not by the client of a server
+    import pymisp
+    logging.basicConfig(level=logging.DEBUG, filename="debug.log", filemode='w', format=pymisp.FORMAT)
+
+def misp_client():
+    import pymisp
+    return pymisp.PyMISP(url=config['MISP']['proto'] + '://' + config['MISP']['host'] + ':' + config['MISP']['port'], key=config['MISP']['token'], ssl=False)
 
 def extract_value(_value, _key, _default=None):
     if _key == '':
@@ -80,164 +108,395 @@ def extract_value(_value, _key, _default=None):
         value = _default if not _default is None else ''
     return value
 
-try:
-    misp = pymisp.PyMISP(url=config['MISP']['proto'] + '://' + config['MISP']['host'] + ':' + config['MISP']['port'], key=config['MISP']['token'], ssl=False)
-    resp = misp.search(controller=args.controller, type_attribute=args.type, org=args.org, last=args.last, date_from=args.date_from, date_to=args.date_to, tags=args.tags, not_tags=args.not_tags, eventid=args.eventid)
-    idxcol = args.idx_col
+class EventCache:
+    # Event metadata (Orgc, info, Tag, ...) by event id, kept on disk so
+    # that runs over overlapping windows don't fetch the same events again.
+    def __init__(self, filename, ttl, memory=0):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        # the most recently used parsed events, for a long running server
+        self.memory = OrderedDict()
+        self.memorysize = memory
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        self.db.execute('CREATE TABLE IF NOT EXISTS events (id TEXT PRIMARY KEY, timestamp INTEGER, fetched INTEGER, event TEXT)')
+
+    def get(self, event_ids):
+        events = {}
+        with self.lock:
+            ids = []
+            for event_id in event_ids:
+                if event_id in self.memory:
+                    events[event_id] = self.memory[event_id]
+                    self.memory.move_to_end(event_id)
+                else:
+                    ids.append(event_id)
+            for i in range(0, len(ids), 500):
+                chunk = ids[i:i + 500]
+                for row in self.db.execute('SELECT id, timestamp, fetched, event FROM events WHERE id IN (%s)' % ','.join('?' * len(chunk)), chunk):
+                    events[row[0]] = (row[1], row[2], json.loads(row[3]))
+                    self.remember(row[0], events[row[0]])
+        return events
+
+    def remember(self, event_id, entry):
+        if self.memorysize <= 0:
+            return
+        self.memory[event_id] = entry
+        self.memory.move_to_end(event_id)
+        while len(self.memory) > self.memorysize:
+            self.memory.popitem(last=False)
+
+    def put(self, events):
+        now = int(time.time())
+        with self.lock:
+            self.db.executemany('INSERT OR REPLACE INTO events VALUES (?, ?, ?, ?)', [(event['id'], int(event.get('timestamp', 0)), now, json.dumps(event)) for event in events])
+            self.db.commit()
+            for event in events:
+                self.remember(event['id'], (int(event.get('timestamp', 0)), now, event))
 
+def search_event_headers(misp, event_ids):
+    resp = misp.search(controller='events', eventid=event_ids, metadata=True)
+    if isinstance(resp, dict):
+        resp = resp['response'] if 'response' in resp else []
+    events = []
+    for event in resp:
+        event = event['Event'] if 'Event' in event else event
+        for key in ['Attribute', 'ShadowAttribute', 'RelatedEvent', 'Galaxy', 'Object']:
+            event.pop(key, None)
+        events.append(event)
+    return events
+
+def load_events(misp, cache, attrs):
+    # newest attribute timestamp per event: a cached event older than that has changed since
+    newest = {}
+    for attr in attrs:
+        newest[attr['event_id']] = max(newest.get(attr['event_id'], 0), int(attr.get('timestamp', 0)))
     events = {}
+    now = int(time.time())
+    for event_id, (timestamp, fetched, event) in cache.get(newest).items():
+        if timestamp >= newest[event_id] and now - fetched < cache.ttl:
+            events[event_id] = event
+    missing = [event_id for event_id in newest if not event_id in events]
+    if missing:
+        batchsize = int(config['cache']['batchsize'])
+        batches = [missing[i:i + batchsize] for i in range(0, len(missing), batchsize)]
+        pool = ThreadPool(int(config['cache']['threads']))
+        try:
+            fetched = [event for batch in pool.imap_unordered(lambda batch: search_event_headers(misp, batch), batches) for event in batch]
+        finally:
+            pool.close()
+            pool.join()
+        cache.put(fetched)
+        for event in fetched:
+            events[event['id']] = event
+    return events
 
-    if args.controller == 'attributes':
-        if 'response' in resp and 'Attribute' in resp['response']:
-            scores = {}
-            rows = {}
-            for attr in resp['response']['Attribute']:
-                if not attr['event_id'] in events:
-                    event = misp.get_event(attr['event_id'])
-                    event = event['Event']
-                    del event['Attribute']
-                    del event['ShadowAttribute']
-                    del event['RelatedEvent']
-                    del event['Galaxy']
-                    del event['Object']
-                    events[attr['event_id']] = event
-                attr['Event'] = events[attr['event_id']]
-                obj = {}
-                if args.out_keys[0] == '*':
-                    obj = attr
-                else:
-                    for _key in args.out_keys:
-                        if 'AS' in _key:
-                            parts = _key.split(' AS ')
-                            _key = parts[0]
-                            _keyname = parts[1]
-                        else:
-                            _keyname = _key.replace('.', '_')
-                        if '.' in _key:
-                            _subkeys = _key.split('.')
-                            _attr=attr[_subkeys[0]]
-                            for _subkey in _subkeys[1:]:
-                                if _subkey in _attr:
-                                    if isinstance(_attr[_subkey], list):
-                                        val = ''
-                                        for elt in _attr[_subkey]:
-                                            if val:
-                                                val += SEP
-                                            val += elt[_subkeys[-1]]
-                                        _attr = val
-                                        break
-                                    else:
-                                        _attr=_attr[_subkey]
-                                else:
-                                    # if key is not part of attribute
-                                    _attr = ''
-                                    break
-                            obj[_keyname] = _attr
-                        else:
-                            obj[_keyname] = attr[_key]
-                if 'comment' in attr:
-                    for field in args.comment_fields:
-                        if 'AS' in field:
-                            parts = field.split(' AS ')
-                            field = parts[0]
-                            fieldname = parts[1]
-                        else:
-                            fieldname = field
-                        match = re.search(field + r'=(.+?)(\t|$)', attr['comment'])
-                        if match:
-                            obj[fieldname] = match.group(1)
-                if not obj[idxcol] in rows:
-                    obj['_count'] = 1
-                    rows[obj[idxcol]] = obj
-                else:
-                    for maxcol in args.max_cols:
-                        if maxcol in obj:
-                            if maxcol in rows[obj[idxcol]]:
-                                rows[obj[idxcol]][maxcol] = max(rows[obj[idxcol]][maxcol], obj[maxcol])
-                    for mvcol in args.mv_cols:
-                        if mvcol in obj:
-                            if mvcol in rows[obj[idxcol]]:
-                                rows[obj[idxcol]][mvcol] += SEP + obj[mvcol]
-                            else:
-                                rows[obj[idxcol]][mvcol] = obj[mvcol]
-                    for mvdistcol in args.mv_dist_cols:
-                        if mvdistcol in obj:
-                            if mvdistcol in rows[obj[idxcol]]:
-                                vals = rows[obj[idxcol]][mvdistcol].split(SEP)
-                                if not obj[mvdistcol] in vals:
-                                    if rows[obj[idxcol]][mvdistcol]:
-                                        rows[obj[idxcol]][mvdistcol] += SEP + obj[mvdistcol]
-                                    else:
-                                        rows[obj[idxcol]][mvdistcol] = obj[mvdistcol]
-                    rows[obj[idxcol]]['_count'] = rows[obj[idxcol]]['_count'] + 1
-            for _,row in rows.items():
-                # tags to category
-                for regex in args.tags_to_category:
-                    if args.tags_field in row:
-                        if isinstance(row[args.tags_field], str):
-                            match = re.search(regex, row[args.tags_field])
-                            if match:
-                                row['category'] = match.group(1)
-                                break
-                # Severity
-                for regex in args.tags_to_severity:
-                    if args.tags_field in row:
-                        if isinstance(row[args.tags_field], str):
-                            match = re.search(regex, str(row[args.tags_field]))
-                            if match:
-                                row['severity'] = match.group(1)
-                                break
-                if not 'severity' in row:
-                    ind1 = int(row['_count'] / 10 * 5 + 1)
-                    # remove _count key because its only used for severity calculation
-                    del row['_count']
-                    if 'popularity' in row:
-                        ind2 = int(row['popularity'])
-                    else:
-                        ind2 = 3
-                    boost = 1
-                    if args.tags_field in row:
-                        for tag in args.severity_boost_tags:
-                            if tag in row[args.tags_field]:
-                                boost += 0.2
-                    row['severity'] = SEVERITY[min(math.ceil((ind1 + ind2) / 2 * boost), 5)]
-                # Harmonizing
-                if 'category' in row:
-                    row['category'] = row['category'].lower()
-                if 'severity' in row:
-                    row['severity'] = row['severity'].lower()
-                # Lookup
-                for section in config.sections():
-                    if section.startswith('lookup:'):
-                        parts = section.split(':')
-                        field = parts[1]
-                        if field in row:
-                            lookup = dict(config.items(section))
-                            for key in lookup:
-                                if key == row[field]:
-                                    row[field] = lookup[key]
-		# mvvalues to array
-                for mvcol in args.mv_cols:
-                    if mvcol in row:
-                        row[mvcol] = row[mvcol].split(SEP)				
-                for mvdistcol in args.mv_dist_cols:
-                    if mvdistcol in row:
-                        row[mvdistcol] = row[mvdistcol].split(SEP)				
-                # Numberic values without quotes
-                for idx,_ in row.items():
-                    if type(row[idx]) == str:
-                        if row[idx].isnumeric():
-                            row[idx] = int(row[idx])
-                    elif type(row[idx]) == list:
-                        for lidx in range(len(row[idx])):
-                            if row[idx][lidx].isnumeric():
-                                row[idx][lidx] = int(row[idx][lidx])
-                                lidx += 1
-                # Output
-                print(json.dumps(row))
-except Exception as e:
-    print(str(e))
-    print(traceback.format_exc())
+def date_slices(date_from, date_to, days):
+    # consecutive, non-overlapping [from, to] windows, both ends inclusive like MISP's date filters
+    start = dt.strptime(date_from, '%Y-%m-%d')
+    end = dt.strptime(date_to, '%Y-%m-%d')
+    while start <= end:
+        stop = min(start + td(days=days - 1), end)
+        yield start.strftime('%Y-%m-%d'), stop.strftime('%Y-%m-%d')
+        start = stop + td(days=1)
+
+class SearchCancelled(Exception):
+    pass
+
+def search_pages(args, misp, cache, date_from, date_to, put):
+    # Puts the attributes of a window, one page at a time, together with the metadata of their events
+    page = 1
+    while True:
+        paging = {'limit': args.page_size, 'page': page} if args.page_size > 0 else {}
+        resp = misp.search(controller=args.controller, type_attribute=args.type, org=args.org, last=args.last, date_from=date_from, date_to=date_to, tags=args.tags, not_tags=args.not_tags, eventid=args.eventid, **paging)
+        attrs = resp['response']['Attribute'] if 'response' in resp and 'Attribute' in resp['response'] else []
+        if attrs:
+            put((attrs, load_events(misp, cache, attrs)))
+        if args.page_size <= 0 or len(attrs) < args.page_size:
+            break
+        page += 1
+
+def search_attributes(args, misp, cache):
+    # Yields pages of attributes as the slices searched by the workers deliver them
+    if args.slice_days > 0 and not args.last:
+        windows = list(date_slices(args.date_from, args.date_to, args.slice_days))
+    else:
+        windows = [(args.date_from, args.date_to)]
+    pages = queue.Queue(maxsize=args.workers * 2)
+    done = object()
+    # set when the consumer stops early, e.g. a client of the server went away
+    cancelled = threading.Event()
+    def put(page):
+        while not cancelled.is_set():
+            try:
+                pages.put(page, timeout=1)
+                return
+            except queue.Full:
+                pass
+        raise SearchCancelled()
+    def worker(window):
+        try:
+            try:
+                search_pages(args, misp, cache, window[0], window[1], put)
+            except SearchCancelled:
+                raise
+            except Exception as e:
+                put(e)
+            put(done)
+        except SearchCancelled:
+            pass
+    pool = ThreadPool(max(1, min(args.workers, len(windows))))
+    pool.map_async(worker, windows)
+    pool.close()
+    remaining = len(windows)
+    error = None
+    try:
+        while remaining:
+            page = pages.get()
+            if page is done:
+                remaining -= 1
+            elif isinstance(page, Exception):
+                # the query fails anyway, the other slices stop at their next page
+                error = page
+                cancelled.set()
+                break
+            else:
+                yield page
+    finally:
+        cancelled.set()
+    pool.join()
+    if error is not None:
+        raise error
+
+def mongo_query(args):
+    # The MISP search filters translated to the IOC collection, where the
+    # feed url stands for the event and the provider for the organisation
+    query = {}
+    if args.type:
+        query['type'] = args.type
+    if args.org:
+        query['provider'] = args.org
+    if args.eventid:
+        query['url'] = args.eventid
+    if args.last:
+        units = {'d': 86400, 'h': 3600, 'm': 60, 's': 1}
+        seconds = int(args.last[:-1]) * units[args.last[-1]] if args.last[-1] in units else int(args.last)
+        query['timestamp'] = {'$gte': dt.now() - td(seconds=seconds)}
+    else:
+        query['timestamp'] = {'$gte': dt.strptime(args.date_from, '%Y-%m-%d'), '$lt': dt.strptime(args.date_to, '%Y-%m-%d') + td(days=1)}
+    tags = {}
+    if args.tags:
+        tags['$in'] = args.tags.split(',')
+    if args.not_tags:
+        tags['$nin'] = args.not_tags.split(',')
+    if tags:
+        query['tags'] = tags
+    return query
+
+def mongo_attribute(doc):
+    # An IOC document shaped like a MISP attribute, the feed url stands for its event
+    return {
+        'id': str(doc['_id']),
+        'event_id': doc['url'],
+        'value': doc['value'],
+        'type': doc['type'],
+        'category': doc['category'],
+        'comment': str(doc['comment']),
+        'uuid': doc['uuid'],
+        'to_ids': doc['to_ids'],
+        'timestamp': str(int(time.mktime(doc['timestamp'].timetuple()))),
+    }
+
+def mongo_event(doc):
+    return {'id': doc['url'], 'info': doc['info'], 'Orgc': {'name': doc['provider']}, 'Tag': [{'name': tag} for tag in doc['tags']]}
+
+def mongo_client():
+    from pymongo import MongoClient
+    return MongoClient(config['mongo']['host'], int(config['mongo']['port']))
+
+def search_mongo(args, client):
+    # Yields pages of attributes from a cursor over the IOC collection
+    db = client[config['mongo']['db']]
+    col = db[config['mongo']['collection']]
+    batchsize = args.page_size if args.page_size > 0 else int(config['mongo']['batchsize'])
+    query = mongo_query(args)
+    projection = dict((key, 1) for key in ['value', 'type', 'category', 'comment', 'uuid', 'to_ids', 'timestamp', 'url', 'info', 'provider', 'tags'])
+    expand = lambda doc: doc
+    if config['mongo']['layout'] == 'compact':
+        from ioclayout import FeedRefs
+        feed_refs = FeedRefs(db)
+        query = feed_refs.query(query)
+        projection = feed_refs.projection(projection)
+        expand = feed_refs.expand
+    attrs = []
+    events = {}
+    # Urls whose IOCs differ in info or tags (MISP feeds) can't share one
+    # event, their attributes carry their own
+    mixed = set()
+    for doc in col.find(query, projection, batch_size=batchsize, no_cursor_timeout=True):
+        doc = expand(doc)
+        attr = mongo_attribute(doc)
+        event = mongo_event(doc)
+        url = attr['event_id']
+        if url in mixed:
+            attr['Event'] = event
+        elif not url in events:
+            events[url] = event
+        elif events[url] != event:
+            for other in attrs:
+                if other['event_id'] == url:
+                    other['Event'] = events[url]
+            del events[url]
+            mixed.add(url)
+            attr['Event'] = event
+        attrs.append(attr)
+        if len(attrs) >= batchsize:
+            yield attrs, events
+            attrs = []
+            events = {}
+            mixed = set()
+    if attrs:
+        yield attrs, events
+
+def run_query(args, sessions, writer):
+    # Writes the rows of the search to writer, the pages come from the
+    # clients sessions opens on first use
+    plan = QueryPlan(args, config)
+    if args.backend == 'mongo':
+        pages = search_mongo(args, sessions.mongo())
+    elif args.controller == 'attributes':
+        pages = search_attributes(args, sessions.misp(), sessions.cache())
+    else:
+        pages = []
+    try:
+        if not args.aggregate:
+            for attrs, events in pages:
+                writer.write_rows(plan.unaggregated(attrs, events))
+                # the rows of a page are passed on before the next one is searched
+                writer.flush()
+            return
+        for attrs, events in pages:
+            plan.aggregate(attrs, events)
+    finally:
+        # stops the searches still running when the writer failed
+        if hasattr(pages, 'close'):
+            pages.close()
+    writer.write_rows(plan.output())
+
+def report_error(e, writer):
+    writer.write(str(e) + '\n')
+    writer.write(traceback.format_exc() + '\n')
     with open('log.txt', 'a') as f:
         f.write(str(e))
         f.write(traceback.format_exc())
+
+class Sessions:
+    # The MISP client, event cache and mongo client, opened when a query
+    # first needs them. A server keeps them for all the queries it answers.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.opened = {}
+
+    def get(self, name, factory):
+        with self.lock:
+            if not name in self.opened:
+                self.opened[name] = factory()
+            return self.opened[name]
+
+    def misp(self):
+        return self.get('misp', misp_client)
+
+    def cache(self):
+        return self.get('cache', lambda: EventCache(config['cache']['events'], int(config['cache']['ttl']), int(config['cache']['memory'])))
+
+    def mongo(self):
+        return self.get('mongo', mongo_client)
+
+    def close(self):
+        if 'mongo' in self.opened:
+            self.opened['mongo'].close()
+
+class QueryHandler(socketserver.StreamRequestHandler):
+    # One query per connection: the parsed arguments as a json line in,
+    # the output of query.py streamed back until the connection closes
+    def handle(self):
+        writer = RowWriter(self.wfile)
+        try:
+            args = argparse.Namespace(**json.loads(self.rfile.readline()))
+            writer = RowWriter(self.wfile, args.gzip)
+            run_query(args, self.server.sessions, writer)
+        except (BrokenPipeError, ConnectionResetError):
+            # the client went away
+            return
+        except Exception as e:
+            report_error(e, writer)
+        writer.close()
+
+class QueryServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+def serve(path):
+    with closing(socket.socket(socket.AF_UNIX)) as sock:
+        if sock.connect_ex(path) == 0:
+            raise Exception('A server is already listening on ' + path)
+    if os.path.exists(path):
+        os.unlink(path)
+    setup_logging()
+    # queries run with the MISP token of the server, only its user may connect.
+    # The socket already listens when the constructor returns, so it is
+    # created with these permissions instead of changing them afterwards.
+    umask = os.umask(0o177)
+    try:
+        server = QueryServer(path, QueryHandler)
+    finally:
+        os.umask(umask)
+    server.sessions = Sessions()
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        server.sessions.close()
+        os.unlink(path)
+
+def query_server(path, args):
+    # Streams the answer of a running server to stdout, False if none is listening
+    sock = socket.socket(socket.AF_UNIX)
+    with closing(sock):
+        try:
+            sock.connect(path)
+        except (FileNotFoundError, ConnectionRefusedError):
+            return False
+        sock.sendall((json.dumps(vars(args)) + '\n').encode())
+        sock.shutdown(socket.SHUT_WR)
+        out = sys.stdout.buffer
+        while True:
+            chunk = sock.recv(64 * 1024)
+            if not chunk:
+                break
+            out.write(chunk)
+        out.flush()
+    return True
+
+def main():
+    args = parse_args()
+    path = config['server']['socket']
+    if args.serve:
+        serve(path)
+        return
+    if not args.local and query_server(path, args):
+        return
+    setup_logging()
+    sessions = Sessions()
+    writer = RowWriter(sys.stdout.buffer, args.gzip)
+    try:
+        run_query(args, sessions, writer)
+    except Exception as e:
+        report_error(e, writer)
+    finally:
+        writer.close()
+        sessions.close()
+
+if __name__ == "__main__":
+    main()
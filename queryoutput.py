@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+
+import io
+import sys
+import json
+import gzip
+import time
+
+class RowWriter:
+    # Writes rows as json lines to a binary stream. Lines are encoded into a
+    # buffer and written in one go once it holds bufsize bytes, instead of a
+    # print for every row.
+    def __init__(self, out, compress=False, bufsize=64 * 1024):
+        # level 1 gets most of the size reduction of json lines in a fraction of the time of level 9
+        self.out = gzip.GzipFile(fileobj=out, mode='wb', compresslevel=1) if compress else out
+        self.compress = compress
+        self.bufsize = bufsize
+        # same output as json.dumps, without the keyword handling and the
+        # cycle check on every call
+        self.encode = json.JSONEncoder(check_circular=False).encode
+        self.lines = []
+        self.size = 0
+
+    def write_rows(self, rows):
+        encode = self.encode
+        lines = self.lines
+        for row in rows:
+            line = encode(row)
+            lines.append(line)
+            self.size += len(line)
+            if self.size >= self.bufsize:
+                self.flush()
+                lines = self.lines
+
+    def write(self, text):
+        # plain text like error messages, after the rows written so far
+        self.flush()
+        self.out.write(text.encode())
+
+    def flush(self):
+        if self.lines:
+            self.lines.append('')
+            self.out.write('\n'.join(self.lines).encode())
+            self.lines = []
+            self.size = 0
+        self.out.flush()
+
+    def close(self):
+        self.flush()
+        if self.compress:
+            # writes the gzip trailer, the stream itself stays open
+            self.out.close()
+
+def sample_rows(count):
+    # rows shaped like the output of QueryPlan
+    return [{'value': 'host%d.example.com' % i, 'type': ['domain'], 'misp_category': ['network activity'], 'timestamp': 1546300800 + i, 'comment': 'popularity=%d' % (i % 5), 'event_id': [i % 97, i % 89], 'organisation': ['Org %d' % (i % 7)], 'info': ['Event %d' % (i % 97)], 'tags': ['tlp:white', 'Kaspersky Lab'], 'popularity': i % 5, 'severity': 'medium'} for i in range(count)]
+
+def benchmark(count=100000):
+    rows = sample_rows(count)
+    out = io.StringIO()
+    stdout = sys.stdout
+    start = time.perf_counter()
+    try:
+        sys.stdout = out
+        for row in rows:
+            print(json.dumps(row))
+    finally:
+        sys.stdout = stdout
+    legacy = time.perf_counter() - start
+    buffer = io.BytesIO()
+    start = time.perf_counter()
+    writer = RowWriter(buffer)
+    writer.write_rows(rows)
+    writer.close()
+    buffered = time.perf_counter() - start
+    if buffer.getvalue().decode() != out.getvalue():
+        print('output differs from print(json.dumps(row))!')
+    compressed = io.BytesIO()
+    start = time.perf_counter()
+    writer = RowWriter(compressed, compress=True)
+    writer.write_rows(rows)
+    writer.close()
+    gzipped = time.perf_counter() - start
+    print('%-10s : %10s : %10s : %10s' % ('', 'seconds', 'rows/s', 'MB'))
+    print('%-10s : %10.2f : %10d : %10.1f' % ('print', legacy, count / legacy, len(out.getvalue()) / 1048576.0))
+    print('%-10s : %10.2f : %10d : %10.1f' % ('buffered', buffered, count / buffered, len(buffer.getvalue()) / 1048576.0))
+    print('%-10s : %10.2f : %10d : %10.1f' % ('gzip', gzipped, count / gzipped, len(compressed.getvalue()) / 1048576.0))
+
+if __name__ == "__main__":
+    benchmark(*[int(arg) for arg in sys.argv[1:2]])
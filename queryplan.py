@@ -0,0 +1,418 @@
+#!/usr/bin/env python3
+
+import re
+import sys
+import json
+import math
+import time
+import argparse
+import operator
+import configparser
+
+SEP = '|'
+SEVERITY=['n/a','informational','low','medium','high','critical']
+
+def compile_extractor(key):
+    # Returns the output name of an --out-key and a function reading it from an attribute
+    if 'AS' in key:
+        parts = key.split(' AS ')
+        key = parts[0]
+        name = parts[1]
+    else:
+        name = key.replace('.', '_')
+    if not '.' in key:
+        return name, operator.itemgetter(key)
+    subkeys = key.split('.')
+    first = subkeys[0]
+    rest = subkeys[1:]
+    last = subkeys[-1]
+    def extract(attr):
+        value = attr[first]
+        for subkey in rest:
+            if not subkey in value:
+                # if key is not part of attribute
+                return ''
+            if isinstance(value[subkey], list):
+                val = ''
+                for elt in value[subkey]:
+                    if val:
+                        val += SEP
+                    val += elt[last]
+                return val
+            value = value[subkey]
+        return value
+    return name, extract
+
+def compile_lookup(lookup):
+    # Every key is compared with the possibly already replaced value, so
+    # chained entries are resolved here once instead of for every row.
+    def resolve(value):
+        for key in lookup:
+            if key == value:
+                value = lookup[key]
+        return value
+    return dict((key, resolve(key)) for key in lookup)
+
+class QueryPlan:
+    # args and config.ini compiled once into what the per-attribute loop
+    # and the per-row output need, and the rows aggregated so far.
+    def __init__(self, args, config):
+        self.idxcol = args.idx_col
+        self.extractors = None if args.out_keys[0] == '*' else [compile_extractor(key) for key in args.out_keys]
+        self.comment_fields = []
+        for field in args.comment_fields:
+            if 'AS' in field:
+                parts = field.split(' AS ')
+                field = parts[0]
+                fieldname = parts[1]
+            else:
+                fieldname = field
+            # one pattern per field: each starts with the field name as a literal
+            # prefix the regex engine scans for, which beats a combined alternation
+            self.comment_fields.append((fieldname, re.compile(field + r'=(.+?)(\t|$)')))
+        self.max_cols = args.max_cols
+        self.mv_cols = args.mv_cols
+        self.mv_dist_cols = args.mv_dist_cols
+        self.tags_field = args.tags_field
+        self.tags_to_category = [re.compile(regex) for regex in args.tags_to_category]
+        self.tags_to_severity = [re.compile(regex) for regex in args.tags_to_severity]
+        self.severity_boost_tags = args.severity_boost_tags
+        self.lookups = [(section.split(':')[1], compile_lookup(dict(config.items(section)))) for section in config.sections() if section.startswith('lookup:')]
+        self.rows = {}
+        self.multi = {}
+        self.distinct = {}
+
+    def project(self, attr, events):
+        # The output columns of one attribute
+        # MISP puts a reduced Event without Orgc and Tag on every attribute,
+        # the fetched one replaces it
+        if attr['event_id'] in events:
+            attr['Event'] = events[attr['event_id']]
+        elif not 'Event' in attr:
+            # events the search did not return (e.g. deleted meanwhile) have no metadata
+            attr['Event'] = {}
+        if self.extractors is None:
+            obj = attr
+        else:
+            obj = {}
+            for name, extract in self.extractors:
+                obj[name] = extract(attr)
+        if 'comment' in attr:
+            comment = attr['comment']
+            for fieldname, regex in self.comment_fields:
+                match = regex.search(comment)
+                if match:
+                    obj[fieldname] = match.group(1)
+        return obj
+
+    def aggregate(self, attrs, events):
+        idxcol = self.idxcol
+        rows = self.rows
+        project = self.project
+        for attr in attrs:
+            obj = project(attr, events)
+            idx = obj[idxcol]
+            if not idx in rows:
+                obj['_count'] = 1
+                rows[idx] = obj
+                # multi values are collected in lists and only joined for the output
+                self.multi[idx] = dict((mvcol, [obj[mvcol]]) for mvcol in self.mv_cols if mvcol in obj)
+                distinct = {}
+                for mvdistcol in self.mv_dist_cols:
+                    if mvdistcol in obj:
+                        vals = obj[mvdistcol].split(SEP)
+                        distinct[mvdistcol] = (vals, set(vals))
+                self.distinct[idx] = distinct
+                continue
+            row = rows[idx]
+            for maxcol in self.max_cols:
+                if maxcol in obj:
+                    if maxcol in row:
+                        row[maxcol] = max(row[maxcol], obj[maxcol])
+            multi = self.multi[idx]
+            for mvcol in self.mv_cols:
+                if mvcol in obj:
+                    if mvcol in multi:
+                        multi[mvcol].append(obj[mvcol])
+                    else:
+                        multi[mvcol] = [obj[mvcol]]
+            distinct = self.distinct[idx]
+            for mvdistcol in self.mv_dist_cols:
+                if mvdistcol in obj and mvdistcol in distinct:
+                    vals, seen = distinct[mvdistcol]
+                    if not obj[mvdistcol] in seen:
+                        if vals != ['']:
+                            parts = obj[mvdistcol].split(SEP)
+                            vals.extend(parts)
+                            seen.update(parts)
+                        else:
+                            vals = obj[mvdistcol].split(SEP)
+                            distinct[mvdistcol] = (vals, set(vals))
+            row['_count'] += 1
+
+    def output(self):
+        # Yields the aggregated rows the way they are printed
+        for idx, row in self.rows.items():
+            for mvcol, vals in self.multi[idx].items():
+                row[mvcol] = SEP.join(vals)
+            for mvdistcol, (vals, _) in self.distinct[idx].items():
+                row[mvdistcol] = SEP.join(vals)
+            yield self.finish(row)
+
+    def unaggregated(self, attrs, events):
+        # Yields a row for every attribute as it is projected, without the
+        # aggregation by idxcol, for consumers that don't need it deduplicated
+        project = self.project
+        finish = self.finish
+        for attr in attrs:
+            row = project(attr, events)
+            row['_count'] = 1
+            yield finish(row)
+
+    def finish(self, row):
+        # The per-row work from the tags to the json types, in place
+        tags_field = self.tags_field
+        tags = row[tags_field] if tags_field in row else None
+        # tags to category
+        if isinstance(tags, str):
+            for regex in self.tags_to_category:
+                match = regex.search(tags)
+                if match:
+                    row['category'] = match.group(1)
+                    break
+        # Severity
+        tags = row[tags_field] if tags_field in row else None
+        if isinstance(tags, str):
+            for regex in self.tags_to_severity:
+                match = regex.search(tags)
+                if match:
+                    row['severity'] = match.group(1)
+                    break
+        if not 'severity' in row:
+            ind1 = int(row['_count'] / 10 * 5 + 1)
+            # remove _count key because its only used for severity calculation
+            del row['_count']
+            if 'popularity' in row:
+                ind2 = int(row['popularity'])
+            else:
+                ind2 = 3
+            boost = 1
+            if tags_field in row:
+                for tag in self.severity_boost_tags:
+                    if tag in row[tags_field]:
+                        boost += 0.2
+            row['severity'] = SEVERITY[min(math.ceil((ind1 + ind2) / 2 * boost), 5)]
+        # Harmonizing
+        if 'category' in row:
+            row['category'] = row['category'].lower()
+        if 'severity' in row:
+            row['severity'] = row['severity'].lower()
+        # Lookup
+        for field, lookup in self.lookups:
+            if field in row and isinstance(row[field], str) and row[field] in lookup:
+                row[field] = lookup[row[field]]
+        # mvvalues to array
+        for mvcol in self.mv_cols:
+            if mvcol in row:
+                row[mvcol] = row[mvcol].split(SEP)
+        for mvdistcol in self.mv_dist_cols:
+            if mvdistcol in row:
+                row[mvdistcol] = row[mvdistcol].split(SEP)
+        # Numberic values without quotes
+        for key, value in row.items():
+            if type(value) is str:
+                if value.isnumeric():
+                    row[key] = int(value)
+            elif type(value) is list:
+                row[key] = [int(val) if val.isnumeric() else val for val in value]
+        return row
+
+def legacy_aggregate(args, rows, attrs, events):
+    # The per-attribute loop of query.py before QueryPlan, kept as the benchmark baseline
+    idxcol = args.idx_col
+    for attr in attrs:
+        attr['Event'] = events[attr['event_id']] if attr['event_id'] in events else {}
+        obj = {}
+        if args.out_keys[0] == '*':
+            obj = attr
+        else:
+            for _key in args.out_keys:
+                if 'AS' in _key:
+                    parts = _key.split(' AS ')
+                    _key = parts[0]
+                    _keyname = parts[1]
+                else:
+                    _keyname = _key.replace('.', '_')
+                if '.' in _key:
+                    _subkeys = _key.split('.')
+                    _attr=attr[_subkeys[0]]
+                    for _subkey in _subkeys[1:]:
+                        if _subkey in _attr:
+                            if isinstance(_attr[_subkey], list):
+                                val = ''
+                                for elt in _attr[_subkey]:
+                                    if val:
+                                        val += SEP
+                                    val += elt[_subkeys[-1]]
+                                _attr = val
+                                break
+                            else:
+                                _attr=_attr[_subkey]
+                        else:
+                            _attr = ''
+                            break
+                    obj[_keyname] = _attr
+                else:
+                    obj[_keyname] = attr[_key]
+        if 'comment' in attr:
+            for field in args.comment_fields:
+                if 'AS' in field:
+                    parts = field.split(' AS ')
+                    field = parts[0]
+                    fieldname = parts[1]
+                else:
+                    fieldname = field
+                match = re.search(field + r'=(.+?)(\t|$)', attr['comment'])
+                if match:
+                    obj[fieldname] = match.group(1)
+        if not obj[idxcol] in rows:
+            obj['_count'] = 1
+            rows[obj[idxcol]] = obj
+        else:
+            for maxcol in args.max_cols:
+                if maxcol in obj:
+                    if maxcol in rows[obj[idxcol]]:
+                        rows[obj[idxcol]][maxcol] = max(rows[obj[idxcol]][maxcol], obj[maxcol])
+            for mvcol in args.mv_cols:
+                if mvcol in obj:
+                    if mvcol in rows[obj[idxcol]]:
+                        rows[obj[idxcol]][mvcol] += SEP + obj[mvcol]
+                    else:
+                        rows[obj[idxcol]][mvcol] = obj[mvcol]
+            for mvdistcol in args.mv_dist_cols:
+                if mvdistcol in obj:
+                    if mvdistcol in rows[obj[idxcol]]:
+                        vals = rows[obj[idxcol]][mvdistcol].split(SEP)
+                        if not obj[mvdistcol] in vals:
+                            if rows[obj[idxcol]][mvdistcol]:
+                                rows[obj[idxcol]][mvdistcol] += SEP + obj[mvdistcol]
+                            else:
+                                rows[obj[idxcol]][mvdistcol] = obj[mvdistcol]
+            rows[obj[idxcol]]['_count'] = rows[obj[idxcol]]['_count'] + 1
+
+def legacy_output(args, config, rows):
+    for _,row in rows.items():
+        for regex in args.tags_to_category:
+            if args.tags_field in row:
+                if isinstance(row[args.tags_field], str):
+                    match = re.search(regex, row[args.tags_field])
+                    if match:
+                        row['category'] = match.group(1)
+                        break
+        for regex in args.tags_to_severity:
+            if args.tags_field in row:
+                if isinstance(row[args.tags_field], str):
+                    match = re.search(regex, str(row[args.tags_field]))
+                    if match:
+                        row['severity'] = match.group(1)
+                        break
+        if not 'severity' in row:
+            ind1 = int(row['_count'] / 10 * 5 + 1)
+            del row['_count']
+            if 'popularity' in row:
+                ind2 = int(row['popularity'])
+            else:
+                ind2 = 3
+            boost = 1
+            if args.tags_field in row:
+                for tag in args.severity_boost_tags:
+                    if tag in row[args.tags_field]:
+                        boost += 0.2
+            row['severity'] = SEVERITY[min(math.ceil((ind1 + ind2) / 2 * boost), 5)]
+        if 'category' in row:
+            row['category'] = row['category'].lower()
+        if 'severity' in row:
+            row['severity'] = row['severity'].lower()
+        for section in config.sections():
+            if section.startswith('lookup:'):
+                parts = section.split(':')
+                field = parts[1]
+                if field in row:
+                    lookup = dict(config.items(section))
+                    for key in lookup:
+                        if key == row[field]:
+                            row[field] = lookup[key]
+        for mvcol in args.mv_cols:
+            if mvcol in row:
+                row[mvcol] = row[mvcol].split(SEP)
+        for mvdistcol in args.mv_dist_cols:
+            if mvdistcol in row:
+                row[mvdistcol] = row[mvdistcol].split(SEP)
+        for idx,_ in row.items():
+            if type(row[idx]) == str:
+                if row[idx].isnumeric():
+                    row[idx] = int(row[idx])
+            elif type(row[idx]) == list:
+                for lidx in range(len(row[idx])):
+                    if row[idx][lidx].isnumeric():
+                        row[idx][lidx] = int(row[idx][lidx])
+        yield row
+
+def sample_attributes(count, distinct):
+    # attributes shaped like a MISP attribute search, many of them sharing a value
+    attrs = []
+    for i in range(count):
+        attrs.append({
+            'id': str(i),
+            'event_id': str(i % 97),
+            'value': 'host%d.example.com' % (i % distinct),
+            'type': 'domain' if i % 3 else 'hostname',
+            'category': 'Network activity' if i % 5 else 'External analysis',
+            'timestamp': str(1546300800 + i),
+            'distribution': str(i % 4),
+            'comment': 'first_seen=2019-01-01\tlast_seen=2019-02-01\tpopularity=%d\tthreat=HEUR:Trojan.Win32.Generic' % (i % 5),
+            # the reduced event of a restSearch result, without Orgc and Tag
+            'Event': {'id': str(i % 97), 'info': 'Event %d' % (i % 97), 'org_id': '1', 'orgc_id': '1', 'uuid': '5c8a0e53-0000-4000-8000-%012d' % (i % 97), 'distribution': '0'},
+        })
+    return attrs
+
+def sample_events():
+    return dict((str(e), {'id': str(e), 'info': 'Event %d' % e, 'Orgc': {'name': 'Org %d' % (e % 7)}, 'Tag': [{'name': 'tlp:white'}, {'name': 'malware_classification:malware-category="Trojan"'}, {'name': 'confidence-in-analytic-judgment="moderate"' if e % 2 else 'Kaspersky Lab'}]}) for e in range(97))
+
+def benchmark(count=100000, distinct=2000, config_file='config.ini'):
+    config = configparser.ConfigParser()
+    config.read(config_file)
+    args = argparse.Namespace(
+        idx_col=config['output']['idxcol'],
+        out_keys=config['output']['keys'].split(','),
+        max_cols=config['output']['maxcols'].split(','),
+        mv_cols=config['output']['mvcols'].split(','),
+        mv_dist_cols=config['output']['mvdistcols'].split(','),
+        comment_fields=config['output']['commentfields'].split(','),
+        severity_boost_tags=config['output']['severityboosttags'].split(','),
+        tags_field=config['output']['tagsfield'],
+        tags_to_category=config['output']['tagstocategory'].split(','),
+        tags_to_severity=config['output']['tagstoseverity'].split(','),
+    )
+    events = sample_events()
+    attrs = sample_attributes(count, distinct)
+    start = time.perf_counter()
+    rows = {}
+    legacy_aggregate(args, rows, attrs, events)
+    expected = [json.dumps(row) for row in legacy_output(args, config, rows)]
+    legacy = time.perf_counter() - start
+    attrs = sample_attributes(count, distinct)
+    start = time.perf_counter()
+    plan = QueryPlan(args, config)
+    plan.aggregate(attrs, events)
+    output = [json.dumps(row) for row in plan.output()]
+    compiled = time.perf_counter() - start
+    if output != expected:
+        print('results differ from the legacy loop!')
+    print('%-10s : %10s : %10s' % ('', 'seconds', 'attrs/s'))
+    print('%-10s : %10.2f : %10d' % ('legacy', legacy, count / legacy))
+    print('%-10s : %10.2f : %10d' % ('plan', compiled, count / compiled))
+    print('speedup %.1fx for %d attributes over %d values' % (legacy / compiled, count, distinct))
+
+if __name__ == "__main__":
+    benchmark(*[int(arg) for arg in sys.argv[1:3]])
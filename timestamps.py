@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+
+import sys
+import time
+import threading
+from functools import lru_cache
+from datetime import datetime as dt
+
+class TimestampParser:
+    # Converts feed timestamps to epoch seconds the way strftime('%s') did:
+    # the parsed fields are interpreted as local time.
+    def __init__(self, timestampformat=None, cachesize=4096):
+        self.format = timestampformat
+        self.fallbacks = 0
+        self.lock = threading.Lock()
+        self.fast = {
+            '%Y-%m-%d': self.parse_date,
+            '%Y-%m-%d %H:%M:%S': self.parse_iso,
+            '%Y-%m-%dT%H:%M:%S': self.parse_iso,
+            '%Y-%m-%dT%H:%M:%S%z': self.parse_iso,
+            '%Y-%m-%d %H:%M:%S%z': self.parse_iso,
+            '%d.%m.%Y %H:%M': self.parse_dotted,
+        }.get(timestampformat)
+        self.cachesize = cachesize
+        self.convert = lru_cache(maxsize=cachesize)(self.convert_uncached)
+
+    def __getstate__(self):
+        # worker processes get a fresh parser with an empty cache and counter
+        return (self.format, self.cachesize)
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+    def __call__(self, timestamp):
+        if isinstance(timestamp, int):
+            return timestamp
+        if self.format is None:
+            return int(timestamp)
+        if self.format == '%sN':
+            return int(timestamp.split('.')[0])
+        return self.convert(timestamp)
+
+    def convert_uncached(self, timestamp):
+        if self.fast is not None:
+            try:
+                return self.epoch(self.fast(timestamp))
+            except ValueError:
+                pass
+        try:
+            return self.epoch(dt.strptime(timestamp, self.format))
+        except ValueError:
+            import dateparser
+            with self.lock:
+                self.fallbacks += 1
+            return self.epoch(dateparser.parse(timestamp))
+
+    def epoch(self, value):
+        return int(time.mktime(value.timetuple()))
+
+    def parse_date(self, timestamp):
+        if len(timestamp) != 10 or timestamp[4] != '-' or timestamp[7] != '-':
+            raise ValueError(timestamp)
+        return dt(int(timestamp[0:4]), int(timestamp[5:7]), int(timestamp[8:10]))
+
+    def parse_dotted(self, timestamp):
+        if len(timestamp) != 16 or timestamp[2] != '.' or timestamp[5] != '.' or timestamp[10] != ' ' or timestamp[13] != ':':
+            raise ValueError(timestamp)
+        return dt(int(timestamp[6:10]), int(timestamp[3:5]), int(timestamp[0:2]), int(timestamp[11:13]), int(timestamp[14:16]))
+
+    def parse_iso(self, timestamp):
+        return dt.fromisoformat(timestamp)
+
+def legacy_convert(timestamp, timestampformat):
+    import dateparser
+    if timestampformat == '%sN':
+        return int(timestamp.split('.')[0])
+    try:
+        timestamp = dt.strftime(dt.strptime(timestamp, timestampformat), '%s')
+    except ValueError:
+        timestamp = dt.strftime(dateparser.parse(timestamp), '%s')
+    return int(timestamp)
+
+def benchmark(rows=100000, distinct=365):
+    samples = {
+        '%Y-%m-%d': lambda i: '2019-%02d-%02d' % (i % 12 + 1, i % 28 + 1),
+        '%Y-%m-%d %H:%M:%S': lambda i: '2019-%02d-%02d %02d:%02d:%02d' % (i % 12 + 1, i % 28 + 1, i % 24, i % 60, i % 60),
+        '%Y-%m-%dT%H:%M:%S%z': lambda i: '2019-%02d-%02dT%02d:%02d:%02d+0000' % (i % 12 + 1, i % 28 + 1, i % 24, i % 60, i % 60),
+        '%d.%m.%Y %H:%M': lambda i: '%02d.%02d.2019 %02d:%02d' % (i % 28 + 1, i % 12 + 1, i % 24, i % 60),
+        '%sN': lambda i: '%d.%d' % (1546300800 + i, i),
+    }
+    print('%-24s : %12s : %12s : %8s' % ('format', 'legacy rows/s', 'parser rows/s', 'speedup'))
+    for timestampformat, sample in samples.items():
+        values = [sample(i % distinct) for i in range(rows)]
+        start = time.perf_counter()
+        expected = [legacy_convert(value, timestampformat) for value in values]
+        legacy = time.perf_counter() - start
+        parser = TimestampParser(timestampformat)
+        start = time.perf_counter()
+        converted = [parser(value) for value in values]
+        compiled = time.perf_counter() - start
+        if converted != expected:
+            print('%-24s : results differ from the legacy conversion!' % timestampformat)
+        print('%-24s : %12d : %12d : %7.1fx' % (timestampformat, rows / legacy, rows / compiled, legacy / compiled))
+
+if __name__ == "__main__":
+    benchmark(*[int(arg) for arg in sys.argv[1:]])